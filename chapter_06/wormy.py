@@ -1,9 +1,20 @@
+import collections
 import random
 import pygame
 import sys
+import time
 from pprint import pprint  # noqa
-
-FPS = 15
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Only needed for the arena mode
+
+FPS = 60         # Frames drawn per second
+TICKRATE = 15    # Times the worm moves per second
+TICKLENGTH = 1 / TICKRATE
+# Longer frames only catch up this many seconds of game ticks, so a long
+# hitch slows the game instead
+MAXFRAMETIME = 0.25
 WINDOWWIDTH = 640
 WINDOWHEIGHT = 480
 CELLSIZE = 20
@@ -34,17 +45,117 @@ directions = {
     RIGHT: {'maps': [pygame.K_RIGHT, pygame.K_d], 'reverse': LEFT}}
 
 HEAD = 0  # Syntactic Sugar: Index of the Worm's Head
+# Most memory rotated surfaces may take up in a rotation cache. The title
+# screen shows its first surface at 120 angles and its second at 45, about
+# 25MB in all; with less, it rotates the ones that don't fit.
+ROTATIONCACHEBYTES = 32 * 1024 * 1024
+# Ticks to wait before looking for a path to the apple again after finding
+# none
+AUTOPILOTRETRY = 8
+
+# The arena mode (python wormy.py --arena) fills a huge board with AI worms
+ARENAWIDTH = 1024     # Cells in the arena
+ARENAHEIGHT = 1024
+ARENAWORMS = 4000
+ARENAAPPLES = 20000
+ARENASTARTLENGTH = 3
+# Chance each tick that an arena worm turns even though it could go straight
+ARENATURNCHANCE = 0.05
+ARENACELLSIZE = 4     # Pixels per cell when drawing the arena
+ARENAVIEWWIDTH = WINDOWWIDTH // ARENACELLSIZE   # Cells shown on the screen
+ARENAVIEWHEIGHT = WINDOWHEIGHT // ARENACELLSIZE
+ARENAPANSPEED = 4     # Cells the view moves each frame an arrow key is held
+ARENABENCHTICKS = 500  # Ticks run by python wormy.py --arena-bench
+# The arena's directions are indexes into these: UP, DOWN, LEFT and RIGHT
+ARENADX = (0, 0, -1, 1)
+ARENADY = (-1, 1, 0, 0)
+ARENAREVERSE = (1, 0, 3, 2)
+ARENACOLORS = ((0, 255, 0), (0, 155, 0), (255, 255, 0), (0, 255, 255),
+               (255, 0, 255), (255, 128, 0), (128, 128, 255),
+               (255, 255, 255))
+
+# The worm is a dictionary with the keys:
+#   'coords' - A deque of the (x, y) cells of the worm's segments, starting
+#              with the head, so moving only touches the two ends.
+#   'occupied' - A bytearray with one entry per cell (at y * CELLWIDTH + x),
+#                1 if a segment is on that cell, so checking if the head hit
+#                the worm takes the same time no matter how long it is.
+#   'freeCells' - A list of the cells without a segment on them, in no
+#                 particular order, so a random one can be picked at once.
+#   'freeIndex' - A list with the position of each cell in freeCells (only
+#                 meaningful for free cells), so a cell can be taken out of
+#                 freeCells by swapping it with the last one.
+#   'crashed' - True once the head has gone off the board or onto another
+#               segment.
+
+
+def makeHamiltonianCycle(width, height):
+    # Return a list with the next cell (at y * width + x) of every cell
+    # along a cycle that visits each cell of the board once, or None if the
+    # board has no such cycle (when both of its sides are odd). The cycle
+    # goes along the first row, snakes back through the other rows leaving
+    # out the first column, and returns along the first column. With an odd
+    # number of rows, the same is done with the rows and columns swapped.
+    if height % 2 == 0:
+        order = getSnakeOrder(width, height)
+    elif width % 2 == 0:
+        order = [(x, y) for y, x in getSnakeOrder(height, width)]
+    else:
+        return None
+    cycleNext = [0] * (width * height)
+    for i, (x, y) in enumerate(order):
+        nextx, nexty = order[(i + 1) % len(order)]
+        cycleNext[y * width + x] = nexty * width + nextx
+    return cycleNext
+
+
+def getSnakeOrder(width, height):
+    # Return the (x, y) cells of the cycle in order, for an even height
+    order = [(x, 0) for x in range(width)]
+    for y in range(1, height):
+        columns = range(width - 1, 0, -1) if y % 2 else range(1, width)
+        order.extend((x, y) for x in columns)
+    order.extend((0, y) for y in range(height - 1, 0, -1))
+    return order
+
+
+def getCycleIndexes(cycleNext):
+    # Return a list with how many moves along the cycle each cell is from
+    # cell 0, or None if there is no cycle
+    if cycleNext is None:
+        return None
+    cycleIndex = [0] * len(cycleNext)
+    cell = 0
+    for i in range(len(cycleNext)):
+        cycleIndex[cell] = i
+        cell = cycleNext[cell]
+    return cycleIndex
+
+
+CYCLENEXT = makeHamiltonianCycle(CELLWIDTH, CELLHEIGHT)
+CYCLEINDEX = getCycleIndexes(CYCLENEXT)
 
 
 def main():
-    global FPSCLOCK, DISPLAYSURF, BASICFONT
+    global FPSCLOCK, DISPLAYSURF, BASICFONT, BACKGROUNDSURF, SEGMENTSURF
+    global APPLESURF
+
+    if '--arena-bench' in sys.argv[1:]:
+        benchmarkArena()
+        return
 
     pygame.init()
     FPSCLOCK = pygame.time.Clock()
     DISPLAYSURF = pygame.display.set_mode((WINDOWWIDTH, WINDOWHEIGHT))
     BASICFONT = pygame.font.Font('freesansbold.ttf', 18)
+    BACKGROUNDSURF = makeBackgroundSurf()
+    SEGMENTSURF = makeSegmentSurf()
+    APPLESURF = makeAppleSurf()
     pygame.display.set_caption('Wormy')
 
+    if '--arena' in sys.argv[1:]:
+        runArena()
+        return
     showStartScreen()
     while True:
         runGame()
@@ -55,11 +166,27 @@ def runGame():
     # Set a random start point.
     startx = random.randint(5, CELLWIDTH - 6)
     starty = random.randint(5, CELLHEIGHT - 6)
-    wormCoords = [{'x': startx - i, 'y': starty} for i in range(3)]
+    worm = newWorm([(startx - i, starty) for i in range(3)])
+    wormCoords = worm['coords']
     direction = RIGHT
+    autopilot = None  # The autopilot's state while it is steering
 
     # Start the apple in a random place.
-    apple = getRandomLocation()
+    apple = getRandomLocation(worm)
+
+    # Draw the whole board once. After that, only the cells that change each
+    # frame (and the score) are drawn and updated on the screen
+    DISPLAYSURF.blit(BACKGROUNDSURF, (0, 0))
+    drawWorm(wormCoords)
+    drawApple(apple)
+    drawScore(0)
+    pygame.display.update()
+    score = 0
+    dirtyCells = set()   # Cells to draw again this frame
+    slides = []          # (from cell, to cell) of the moving segments
+    movingCells = set()  # Cells the moving segments were drawn on
+    accumulator = 0.0    # Game time that hasn't been ticked yet
+    FPSCLOCK.tick()      # Don't count the time before the game started
 
     while True:  # Main Game Loop
         for event in pygame.event.get():  # Event Handling Loop
@@ -68,42 +195,87 @@ def runGame():
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_ESCAPE:
                     terminate()
+                # Let the autopilot steer (or give control back)
+                if event.key == pygame.K_TAB:
+                    autopilot = None if autopilot else newAutopilot()
                 for d, v in directions.items():
                     if event.key in v['maps'] and direction != v['reverse']:
                         direction = d
                         break
 
-        # Check if the worm has hit itself or the edge.
-        if any([wormCoords[HEAD]['x'] not in range(CELLWIDTH),
-                wormCoords[HEAD]['y'] not in range(CELLHEIGHT),
-                wormCoords[HEAD] in wormCoords[1:]]):
-            return  # Game Over
-
-        # Check if the worm has eaten an apple.
-        if wormCoords[HEAD] == apple:
-            apple = getRandomLocation()  # Don't remove the worm's tail.
+        # Move the worm once for every TICKLENGTH of time that has passed,
+        # however many frames that took
+        while accumulator >= TICKLENGTH:
+            accumulator -= TICKLENGTH
+
+            # Check if the worm has hit itself or the edge.
+            if worm['crashed']:
+                return  # Game Over
+
+            # Check if the worm has eaten an apple.
+            slides = []
+            if wormCoords[HEAD] == apple:
+                dirtyCells.add(apple)
+                apple = getRandomLocation(worm)  # Don't remove the tail.
+                if apple is None:
+                    return  # The worm fills the whole board
+                dirtyCells.add(apple)
+            else:
+                # The tail slides onto the next segment as it is removed.
+                slides.append((wormCoords[-1], wormCoords[-2]))
+                removeTail(worm)
+
+            if autopilot:
+                direction = (chooseDirection(worm, apple, autopilot) or
+                             direction)
+
+            # Move the worm by adding a segment in the direction it is
+            # moving.
+            x, y = wormCoords[HEAD]
+            if direction == UP:
+                y -= 1
+            elif direction == DOWN:
+                y += 1
+            elif direction == LEFT:
+                x -= 1
+            elif direction == RIGHT:
+                x += 1
+            addHead(worm, x, y)
+            if not worm['crashed']:
+                slides.append((wormCoords[1], wormCoords[HEAD]))
+            else:
+                dirtyCells.add(wormCoords[HEAD])
+            for slide in slides:
+                dirtyCells.update(slide)
+
+        # Draw the moving segments part of the way to their new cells, as
+        # far as the time until the next tick says. The cells they were
+        # drawn on last frame have to be drawn again too.
+        alpha = accumulator / TICKLENGTH
+        sprites = [getSlidePosition(fromCell, toCell, alpha)
+                   for fromCell, toCell in slides]
+        hidden = {slides[-1][1]} if slides and not worm['crashed'] else ()
+        dirtyCells.update(movingCells)
+        movingCells = {cell for slide in slides for cell in slide}
+        dirtyCells.update(movingCells)
+
+        # The score is drawn over the board, so if it or a cell under it
+        # changed, all of the cells under it are drawn again before it
+        oldScore = score
+        score = len(wormCoords) - 3
+        scoreRect = getScoreRect(oldScore).union(getScoreRect(score))
+        if score != oldScore or scoreRect.collidelist(
+                [getCellRect(cell) for cell in dirtyCells]) != -1:
+            dirtyCells.update(getCellsInRect(scoreRect))
         else:
-            del wormCoords[-1]           # Remove the worm's tail.
-
-        # Move the worm by adding a segment in the direction it is moving.
-        newHead = dict(wormCoords[HEAD])
-        if direction == UP:
-            newHead['y'] -= 1
-        elif direction == DOWN:
-            newHead['y'] += 1
-        elif direction == LEFT:
-            newHead['x'] -= 1
-        elif direction == RIGHT:
-            newHead['x'] += 1
-        wormCoords.insert(0, newHead)
+            scoreRect = None
 
-        DISPLAYSURF.fill(BGCOLOR)
-        drawGrid()
-        drawWorm(wormCoords)
-        drawApple(apple)
-        drawScore(len(wormCoords) - 3)
-        pygame.display.update()
-        FPSCLOCK.tick(FPS)
+        dirtyRects = drawCells(dirtyCells, worm, apple, hidden, sprites)
+        if scoreRect:
+            drawScore(score)
+        pygame.display.update(dirtyRects)
+        dirtyCells = set()
+        accumulator += min(FPSCLOCK.tick(FPS) / 1000, MAXFRAMETIME)
 
 
 def drawPressKeyMsg():
@@ -130,16 +302,19 @@ def showStartScreen():
     titleSurf1 = titleFont.render('Wormy!', True, WHITE, DARKGREEN)
     titleSurf2 = titleFont.render('Wormy!', True, GREEN)
 
+    # The titles come back to the same angles every 120 and 45 frames, so
+    # each angle is only rotated the first time it is shown
+    rotationCache = newRotationCache()
     degrees1 = 0
     degrees2 = 0
     while True:
         DISPLAYSURF.fill(BGCOLOR)
-        rotatedSurf1 = pygame.transform.rotate(titleSurf1, degrees1)
+        rotatedSurf1 = getRotatedSurf(rotationCache, titleSurf1, degrees1)
         rotatedRect1 = rotatedSurf1.get_rect()
         rotatedRect1.center = (WINDOWWIDTH / 2, WINDOWHEIGHT / 2)
         DISPLAYSURF.blit(rotatedSurf1, rotatedRect1)
 
-        rotatedSurf2 = pygame.transform.rotate(titleSurf2, degrees2)
+        rotatedSurf2 = getRotatedSurf(rotationCache, titleSurf2, degrees2)
         rotatedRect2 = rotatedSurf2.get_rect()
         rotatedRect2.center = (WINDOWWIDTH / 2, WINDOWHEIGHT / 2)
         DISPLAYSURF.blit(rotatedSurf2, rotatedRect2)
@@ -150,9 +325,46 @@ def showStartScreen():
             pygame.event.get()  # Clear Event Queue
             return
         pygame.display.update()
-        FPSCLOCK.tick(FPS)
+        FPSCLOCK.tick(TICKRATE)  # The title turns once per game tick.
         degrees1 += 3  # Rotate by 3 degrees each frame.
-        degrees2 += 7  # Rotate by 7 degrees each frame.
+        degrees2 += 8  # Rotate by 8 degrees each frame.
+
+
+def newRotationCache(maxBytes=ROTATIONCACHEBYTES):
+    # Return a cache of rotated surfaces for getRotatedSurf(), which
+    # forgets the least recently used ones to stay under maxBytes
+    return {
+        'surfaces': collections.OrderedDict(),  # By (surface, degrees),
+                                                # least recently used first
+        'bytes': 0,
+        'maxBytes': maxBytes}
+
+
+def getRotatedSurf(cache, surf, degrees):
+    # Return surf rotated by degrees, as pygame.transform.rotate() does, but
+    # only rotate it the first time an angle is asked for. The cache keeps
+    # surf alive, so it must not be changed afterwards
+    degrees %= 360
+    key = (surf, degrees)
+    surfaces = cache['surfaces']
+    rotatedSurf = surfaces.get(key)
+    if rotatedSurf is not None:
+        surfaces.move_to_end(key)
+        return rotatedSurf
+
+    rotatedSurf = pygame.transform.rotate(surf, degrees)
+    surfBytes = getSurfBytes(rotatedSurf)
+    if surfBytes <= cache['maxBytes']:
+        surfaces[key] = rotatedSurf
+        cache['bytes'] += surfBytes
+        while cache['bytes'] > cache['maxBytes']:
+            oldKey, oldSurf = surfaces.popitem(last=False)
+            cache['bytes'] -= getSurfBytes(oldSurf)
+    return rotatedSurf
+
+
+def getSurfBytes(surf):
+    return surf.get_pitch() * surf.get_height()
 
 
 def terminate():
@@ -160,10 +372,296 @@ def terminate():
     sys.exit()
 
 
-def getRandomLocation():
+def getRandomLocation(worm):
+    # Return a random cell that the worm isn't on, or None if there are none
+    if not worm['freeCells']:
+        return None
+    cell = random.choice(worm['freeCells'])
+    return (cell % CELLWIDTH, cell // CELLWIDTH)
+
+
+def newWorm(coords):
+    # Create a worm from its (x, y) cells, starting with the head
+    worm = {'coords': collections.deque(),
+            'occupied': bytearray(CELLWIDTH * CELLHEIGHT),
+            'freeCells': list(range(CELLWIDTH * CELLHEIGHT)),
+            'freeIndex': list(range(CELLWIDTH * CELLHEIGHT)),
+            'crashed': False}
+    for x, y in reversed(coords):
+        addHead(worm, x, y)
+    return worm
+
+
+def addHead(worm, x, y):
+    # Add a segment in front of the head, and note if it hit the edge of the
+    # board or another segment
+    worm['coords'].appendleft((x, y))
+    if not (0 <= x < CELLWIDTH and 0 <= y < CELLHEIGHT):
+        worm['crashed'] = True
+    elif worm['occupied'][y * CELLWIDTH + x]:
+        worm['crashed'] = True
+    else:
+        occupyCell(worm, y * CELLWIDTH + x)
+
+
+def removeTail(worm):
+    x, y = worm['coords'].pop()
+    freeCell(worm, y * CELLWIDTH + x)
+
+
+def occupyCell(worm, cell):
+    # Take the cell out of freeCells by moving the last free cell into its
+    # place
+    freeCells = worm['freeCells']
+    lastCell = freeCells.pop()
+    if lastCell != cell:
+        i = worm['freeIndex'][cell]
+        freeCells[i] = lastCell
+        worm['freeIndex'][lastCell] = i
+    worm['occupied'][cell] = 1
+
+
+def freeCell(worm, cell):
+    worm['freeIndex'][cell] = len(worm['freeCells'])
+    worm['freeCells'].append(cell)
+    worm['occupied'][cell] = 0
+
+
+def newAutopilot():
     return {
-        'x': random.randint(0, CELLWIDTH - 1),
-        'y': random.randint(0, CELLHEIGHT - 1)}
+        'path': collections.deque(),  # Cells left on the way to the apple
+        'apple': None,       # The apple the path leads to
+        'expectedHead': None,  # Where the head should be if on the path
+        'nextSearch': 0,     # Tick to look for a path to the apple again
+        'ticks': 0,
+        'inCycleOrder': False}  # If the worm lies in order along CYCLENEXT
+
+
+def chooseDirection(worm, apple, autopilot):
+    # Return the direction for the worm's next move (after its tail has been
+    # removed for this tick), or None if it has nowhere to go. The autopilot
+    # follows the cycle in CYCLENEXT. Once the worm lies in order along it,
+    # the autopilot keeps it that way, only taking shortcuts to the apple
+    # while there is plenty of room ahead of the head (see findShortcut()).
+    # Until then it follows the cycle wherever it can still reach its tail.
+    # A path is kept until the apple moves or the worm leaves it.
+    headx, heady = worm['coords'][HEAD]
+    head = heady * CELLWIDTH + headx
+    path = autopilot['path']
+    if apple != autopilot['apple']:
+        autopilot['apple'] = apple
+        autopilot['nextSearch'] = 0
+        path.clear()
+    elif head != autopilot['expectedHead']:
+        autopilot['inCycleOrder'] = False
+        path.clear()
+
+    appleCell = apple[1] * CELLWIDTH + apple[0] if apple else None
+    autopilot['ticks'] += 1
+    if CYCLENEXT is None:
+        # Without a cycle, take the apple whenever the worm could still
+        # reach its tail after eating it
+        if (not path and apple is not None and
+                autopilot['ticks'] >= autopilot['nextSearch']):
+            newPath = findSafePath(worm, appleCell)
+            if newPath:
+                path.extend(newPath)
+            else:
+                autopilot['nextSearch'] = autopilot['ticks'] + AUTOPILOTRETRY
+    else:
+        if not autopilot['inCycleOrder']:
+            autopilot['inCycleOrder'] = isInCycleOrder(worm)
+        if autopilot['inCycleOrder'] and not path and apple is not None:
+            path.extend(findShortcut(worm, head, appleCell))
+
+    if path and not worm['occupied'][path[0]]:
+        nextCell = path.popleft()
+    elif autopilot['inCycleOrder']:
+        path.clear()
+        nextCell = CYCLENEXT[head]
+    else:
+        path.clear()
+        nextCell = findSafeMove(worm, head, appleCell)
+        if nextCell is None:
+            return None
+    autopilot['expectedHead'] = nextCell
+    return getDirection(head, nextCell)
+
+
+def getCycleDistance(fromCell, toCell):
+    # Return how many moves along the cycle it takes to get from fromCell to
+    # toCell
+    return (CYCLEINDEX[toCell] - CYCLEINDEX[fromCell]) % len(CYCLEINDEX)
+
+
+def isInCycleOrder(worm):
+    # Return True if the worm's segments come one after another along the
+    # cycle from the tail to the head, and it is safe to keep following the
+    # cycle from here. The free cells between the segments (the gaps) are
+    # only freed up as the tail passes them, so there must either be none,
+    # or more free cells ahead of the head than the worm is long.
+    coords = worm['coords']
+    tailx, taily = coords[-1]
+    tail = taily * CELLWIDTH + tailx
+    previous = -1
+    for x, y in reversed(coords):
+        distance = getCycleDistance(tail, y * CELLWIDTH + x)
+        if distance <= previous:
+            return False
+        previous = distance
+    freeAhead = len(CYCLEINDEX) - previous - 1
+    return previous == len(coords) - 1 or freeAhead >= len(coords)
+
+
+def findShortcut(worm, head, goal):
+    # Return the cells of the shortest path from the head to the goal that
+    # only moves forward along the cycle and doesn't go past the goal, or an
+    # empty list if the worm shouldn't take a shortcut now. With the worm in
+    # cycle order, all of those cells are free and the worm is still in
+    # cycle order after following the path. The cells it skips are only
+    # freed up as the tail passes them, so a shortcut is only taken if the
+    # goal is before the tail and, after eating there, more free cells would
+    # still be ahead of the head than the worm is long.
+    coords = worm['coords']
+    tailx, taily = coords[-1]
+    tailDistance = getCycleDistance(head, taily * CELLWIDTH + tailx)
+    goalDistance = getCycleDistance(head, goal)
+    if tailDistance - goalDistance - 1 <= len(coords):
+        return []
+
+    # The cells' distances from the head along the cycle are worked out
+    # inline, as this searches up to the whole board
+    cycleIndex = CYCLEINDEX
+    numCells = len(cycleIndex)
+    headIndex = cycleIndex[head]
+    cameFrom = {head: None}
+    queue = collections.deque([head])
+    while queue:
+        cell = queue.popleft()
+        if cell == goal:
+            break
+        distance = (cycleIndex[cell] - headIndex) % numCells
+        for neighbor in getNeighbors(cell):
+            if (neighbor not in cameFrom and distance <
+                    (cycleIndex[neighbor] - headIndex) % numCells <=
+                    goalDistance):
+                cameFrom[neighbor] = cell
+                queue.append(neighbor)
+    path = []
+    while cell != head:
+        path.append(cell)
+        cell = cameFrom[cell]
+    path.reverse()
+    return path
+
+
+def findSafePath(worm, goal):
+    # Return the cells of the shortest path from the head to the goal, if
+    # the worm could still reach its tail after following it and eating
+    # there, or None
+    coords = worm['coords']
+    headx, heady = coords[HEAD]
+    path = findPath(worm['occupied'], heady * CELLWIDTH + headx, goal)
+    if path is None:
+        return None
+
+    # Follow the path with a copy of the worm. The tail is removed on every
+    # move but the first (it was already removed this tick)
+    occupied = bytearray(worm['occupied'])
+    cells = collections.deque(y * CELLWIDTH + x for x, y in coords)
+    for i, cell in enumerate(path):
+        if i:
+            occupied[cells.pop()] = 0
+        cells.appendleft(cell)
+        occupied[cell] = 1
+    if not isTailReachable(occupied, cells[HEAD], cells[-1]):
+        return None
+    return path
+
+
+def findSafeMove(worm, head, appleCell):
+    # Return the cell to move to when the worm has no safe path to follow:
+    # the next cell of the cycle if the worm can reach its tail from there,
+    # or else the first such neighbor. The apple is avoided, since the worm
+    # grows when it eats it.
+    occupied = worm['occupied']
+    cycleNext = CYCLENEXT[head] if CYCLENEXT else None
+    candidates = [cell for cell in getNeighbors(head)
+                  if not occupied[cell] and cell != appleCell]
+    if cycleNext in candidates:
+        candidates.remove(cycleNext)
+        candidates.insert(0, cycleNext)
+    tailx, taily = worm['coords'][-1]
+    for cell in candidates:
+        occupied[cell] = 1
+        safe = isTailReachable(occupied, cell, taily * CELLWIDTH + tailx)
+        occupied[cell] = 0
+        if safe:
+            return cell
+    if candidates:
+        return candidates[0]
+    if appleCell in getNeighbors(head):
+        return appleCell
+    return None
+
+
+def findPath(occupied, start, goal):
+    # Return the cells of the shortest path from start to goal over free
+    # cells (not including start), or None if there is none
+    cameFrom = {start: None}
+    queue = collections.deque([start])
+    while queue:
+        cell = queue.popleft()
+        if cell == goal:
+            break
+        for neighbor in getNeighbors(cell):
+            if neighbor not in cameFrom and not occupied[neighbor]:
+                cameFrom[neighbor] = cell
+                queue.append(neighbor)
+    else:
+        return None
+    path = []
+    while cell != start:
+        path.append(cell)
+        cell = cameFrom[cell]
+    path.reverse()
+    return path
+
+
+def isTailReachable(occupied, head, tail):
+    # Return True if the head can move onto free cells and get next to the
+    # tail, so the worm can keep following its tail
+    visited = {head}
+    queue = collections.deque([head])
+    while queue:
+        cell = queue.popleft()
+        for neighbor in getNeighbors(cell):
+            if neighbor == tail and cell != head:
+                return True
+            if neighbor not in visited and not occupied[neighbor]:
+                visited.add(neighbor)
+                queue.append(neighbor)
+    return False
+
+
+def getNeighbors(cell):
+    # Return the cells next to the cell on the board
+    x = cell % CELLWIDTH
+    neighbors = []
+    if x > 0:
+        neighbors.append(cell - 1)
+    if x < CELLWIDTH - 1:
+        neighbors.append(cell + 1)
+    if cell >= CELLWIDTH:
+        neighbors.append(cell - CELLWIDTH)
+    if cell < CELLWIDTH * (CELLHEIGHT - 1):
+        neighbors.append(cell + CELLWIDTH)
+    return neighbors
+
+
+def getDirection(fromCell, toCell):
+    return {-1: LEFT, 1: RIGHT, -CELLWIDTH: UP,
+            CELLWIDTH: DOWN}[toCell - fromCell]
 
 
 def showGameOverScreen():
@@ -188,36 +686,333 @@ def showGameOverScreen():
             return
 
 
+def getScoreRect(score):
+    width, height = BASICFONT.size(f'Score: {score}')
+    return pygame.Rect(WINDOWWIDTH - 120, 10, width, height)
+
+
 def drawScore(score):
     scoreSurf = BASICFONT.render(f'Score: {score}', True, WHITE)
-    scoreRect = scoreSurf.get_rect()
-    scoreRect.topleft = (WINDOWWIDTH - 120, 10)
-    DISPLAYSURF.blit(scoreSurf, scoreRect)
+    DISPLAYSURF.blit(scoreSurf, getScoreRect(score))
+
+
+def makeBackgroundSurf():
+    # Render the background and grid once, so cells can be cleared by
+    # copying them from it
+    backgroundSurf = pygame.Surface((WINDOWWIDTH, WINDOWHEIGHT)).convert()
+    backgroundSurf.fill(BGCOLOR)
+    drawGrid(backgroundSurf)
+    return backgroundSurf
+
+
+def makeSegmentSurf():
+    segmentSurf = pygame.Surface((CELLSIZE, CELLSIZE)).convert()
+    segmentSurf.fill(DARKGREEN)
+    segmentSurf.fill(GREEN, (4, 4, CELLSIZE - 8, CELLSIZE - 8))
+    return segmentSurf
+
+
+def makeAppleSurf():
+    appleSurf = pygame.Surface((CELLSIZE, CELLSIZE)).convert()
+    appleSurf.fill(RED)
+    return appleSurf
+
+
+def getCellRect(cell):
+    return pygame.Rect(cell[0] * CELLSIZE, cell[1] * CELLSIZE,
+                       CELLSIZE, CELLSIZE)
+
+
+def getCellsInRect(rect):
+    # Return the (x, y) cells that the rect in pixels overlaps
+    return {(x, y)
+            for x in range(rect.left // CELLSIZE,
+                           (rect.right - 1) // CELLSIZE + 1)
+            for y in range(rect.top // CELLSIZE,
+                           (rect.bottom - 1) // CELLSIZE + 1)}
+
+
+def drawCells(cells, worm, apple, hidden=(), sprites=()):
+    # Draw the background and whatever is on each (x, y) cell, leaving out
+    # the segments on the hidden cells, then the segments at the (x, y)
+    # pixel positions in sprites and the apple over them. Returns the rects
+    # that were drawn. Cells off the board are skipped
+    rects = []
+    for cell in cells:
+        x, y = cell
+        if not (0 <= x < CELLWIDTH and 0 <= y < CELLHEIGHT):
+            continue
+        cellRect = getCellRect(cell)
+        DISPLAYSURF.blit(BACKGROUNDSURF, cellRect, cellRect)
+        if worm['occupied'][y * CELLWIDTH + x] and cell not in hidden:
+            DISPLAYSURF.blit(SEGMENTSURF, cellRect)
+        rects.append(cellRect)
+    for position in sprites:
+        rects.append(DISPLAYSURF.blit(SEGMENTSURF, position))
+    if apple in cells:
+        DISPLAYSURF.blit(APPLESURF, getCellRect(apple))
+    return rects
+
+
+def getSlidePosition(fromCell, toCell, alpha):
+    # Return the pixel position of a segment alpha (0 to 1) of the way from
+    # one cell to the next
+    return (round((fromCell[0] + (toCell[0] - fromCell[0]) * alpha) *
+                  CELLSIZE),
+            round((fromCell[1] + (toCell[1] - fromCell[1]) * alpha) *
+                  CELLSIZE))
 
 
 def drawWorm(wormCoords):
-    for coord in wormCoords:
-        x = coord['x'] * CELLSIZE
-        y = coord['y'] * CELLSIZE
-        wormSegmentRect = pygame.Rect(x, y, CELLSIZE, CELLSIZE)
-        pygame.draw.rect(DISPLAYSURF, DARKGREEN, wormSegmentRect)
-        wormInnerSegmentRect = pygame.Rect(x + 4, y + 4,
-                                           CELLSIZE - 8, CELLSIZE - 8)
-        pygame.draw.rect(DISPLAYSURF, GREEN, wormInnerSegmentRect)
+    for cellx, celly in wormCoords:
+        DISPLAYSURF.blit(SEGMENTSURF, (cellx * CELLSIZE, celly * CELLSIZE))
 
 
 def drawApple(coord):
-    x = coord['x'] * CELLSIZE
-    y = coord['y'] * CELLSIZE
-    appleRect = pygame.Rect(x, y, CELLSIZE, CELLSIZE)
-    pygame.draw.rect(DISPLAYSURF, RED, appleRect)
+    DISPLAYSURF.blit(APPLESURF, (coord[0] * CELLSIZE, coord[1] * CELLSIZE))
 
 
-def drawGrid():
+def drawGrid(surf):
     for x in range(0, WINDOWWIDTH, CELLSIZE):  # Draw vertical lines.
-        pygame.draw.line(DISPLAYSURF, DARKGRAY, (x, 0), (x, WINDOWHEIGHT))
+        pygame.draw.line(surf, DARKGRAY, (x, 0), (x, WINDOWHEIGHT))
     for y in range(0, WINDOWHEIGHT, CELLSIZE):  # Draw horizontal lines.
-        pygame.draw.line(DISPLAYSURF, DARKGRAY, (0, y), (WINDOWWIDTH, y))
+        pygame.draw.line(surf, DARKGRAY, (0, y), (WINDOWWIDTH, y))
+
+
+# The arena is a dictionary of NumPy arrays. Instead of keeping a list of
+# segments for every worm, each cell remembers which worm last entered it
+# and when; a worm is still on a cell as long as it entered it less than
+# its length ticks ago. So moving a worm only writes its new head cell,
+# and the tail disappears by itself. The keys are:
+#   'owner' - ARENAHEIGHT x ARENAWIDTH, the worm that last entered each
+#             cell, or -1
+#   'stamp' - ARENAHEIGHT x ARENAWIDTH, the tick each cell was last entered
+#   'apples' - ARENAHEIGHT x ARENAWIDTH booleans, True where an apple is
+#   'x', 'y', 'direction' - The head and direction of each worm
+#   'length' - The length of each worm
+#   'born' - The tick each worm (re)started; cells entered before it are
+#            left over from its last life and are free
+#   'alive' - False for worms that crashed and are waiting for a free cell
+#             to start again on
+#   'numApples', 'tick', 'random' - The number of apples, the number of
+#             ticks so far and the numpy.random.Generator used for
+#             everything random
+
+
+def newArena(numWorms=ARENAWORMS, seed=None):
+    if numpy is None:
+        raise ImportError('The arena mode needs NumPy')
+    arena = {
+        'owner': numpy.full((ARENAHEIGHT, ARENAWIDTH), -1, dtype=numpy.int32),
+        'stamp': numpy.zeros((ARENAHEIGHT, ARENAWIDTH), dtype=numpy.int64),
+        'apples': numpy.zeros((ARENAHEIGHT, ARENAWIDTH), dtype=bool),
+        'numApples': 0,
+        'tick': 0,
+        'random': numpy.random.default_rng(seed)}
+    for key in ('x', 'y', 'direction', 'length', 'born'):
+        arena[key] = numpy.zeros(numWorms, dtype=numpy.int64)
+    arena['alive'] = numpy.zeros(numWorms, dtype=bool)
+    respawnArenaWorms(arena)
+    addArenaApples(arena)
+    return arena
+
+
+def isArenaOccupied(arena, xs, ys):
+    # Return a boolean array telling if a worm is on each (x, y) cell
+    owner = arena['owner'][ys, xs]
+    stamp = arena['stamp'][ys, xs]
+    worm = numpy.maximum(owner, 0)
+    return ((owner >= 0) & arena['alive'][worm] &
+            (stamp > arena['tick'] - arena['length'][worm]) &
+            (stamp >= arena['born'][worm]))
+
+
+def isArenaFree(arena, xs, ys):
+    # Return a boolean array telling if each (x, y) is a cell on the arena
+    # without a worm on it
+    onArena = (xs >= 0) & (xs < ARENAWIDTH) & (ys >= 0) & (ys < ARENAHEIGHT)
+    free = onArena.copy()
+    free[onArena] = ~isArenaOccupied(arena, xs[onArena], ys[onArena])
+    return free
+
+
+def chooseArenaDirections(arena, worms):
+    # Return the direction each of the given worms moves in: straight on if
+    # that cell is free (except for a random turn now and then), or else a
+    # random free direction
+    rng = arena['random']
+    scores = rng.random((len(worms), 4))
+    direction = arena['direction'][worms]
+    goStraight = rng.random(len(worms)) >= ARENATURNCHANCE
+    scores[numpy.arange(len(worms)), direction] += 2 * goStraight
+    for d in range(4):
+        free = isArenaFree(arena, arena['x'][worms] + ARENADX[d],
+                           arena['y'][worms] + ARENADY[d])
+        scores[:, d] += 4 * free
+    scores[numpy.arange(len(worms)),
+           numpy.take(ARENAREVERSE, direction)] = -1
+    return scores.argmax(axis=1)
+
+
+def stepArena(arena):
+    # Move every worm in the arena one cell, and return how many crashed.
+    # Worms crash into the edge and other worms as in the normal game, and
+    # worms whose heads meet on the same cell both crash. Crashed worms
+    # start again on random free cells
+    arena['tick'] += 1
+    tick = arena['tick']
+    worms = numpy.flatnonzero(arena['alive'])
+    direction = chooseArenaDirections(arena, worms)
+    xs = arena['x'][worms] + numpy.take(ARENADX, direction)
+    ys = arena['y'][worms] + numpy.take(ARENADY, direction)
+
+    # Worms grow by one for each apple they eat. They grow before checking
+    # where the worms can move, so their tails aren't taken as free cells
+    onArena = (xs >= 0) & (xs < ARENAWIDTH) & (ys >= 0) & (ys < ARENAHEIGHT)
+    ate = onArena.copy()
+    ate[onArena] = arena['apples'][ys[onArena], xs[onArena]]
+    arena['length'][worms[ate]] += 1
+
+    moved = isArenaFree(arena, xs, ys)
+    # Heads off the arena get the cell -1, so they can't meet a head on a
+    # real cell that has the same index
+    cells, inverse, counts = numpy.unique(
+        numpy.where(onArena, ys * ARENAWIDTH + xs, -1),
+        return_inverse=True, return_counts=True)
+    moved &= counts[inverse] == 1
+    crashed = worms[~moved]
+    arena['alive'][crashed] = False
+
+    worms = worms[moved]
+    xs = xs[moved]
+    ys = ys[moved]
+    arena['x'][worms] = xs
+    arena['y'][worms] = ys
+    arena['direction'][worms] = direction[moved]
+    arena['owner'][ys, xs] = worms
+    arena['stamp'][ys, xs] = tick
+    ate = ate[moved]
+    arena['apples'][ys[ate], xs[ate]] = False
+    arena['numApples'] -= int(ate.sum())
+
+    respawnArenaWorms(arena)
+    addArenaApples(arena)
+    return len(crashed)
+
+
+def respawnArenaWorms(arena):
+    # Start the worms that aren't alive on random free cells. Worms whose
+    # cell is taken try again next tick
+    worms = numpy.flatnonzero(~arena['alive'])
+    if not len(worms):
+        return
+    rng = arena['random']
+    xs = rng.integers(0, ARENAWIDTH, len(worms))
+    ys = rng.integers(0, ARENAHEIGHT, len(worms))
+    # Only one worm can start on each cell
+    first = numpy.zeros(len(worms), dtype=bool)
+    first[numpy.unique(ys * ARENAWIDTH + xs, return_index=True)[1]] = True
+    free = first & isArenaFree(arena, xs, ys)
+    worms, xs, ys = worms[free], xs[free], ys[free]
+    arena['x'][worms] = xs
+    arena['y'][worms] = ys
+    arena['direction'][worms] = rng.integers(0, 4, len(worms))
+    arena['length'][worms] = ARENASTARTLENGTH
+    arena['born'][worms] = arena['tick']
+    arena['alive'][worms] = True
+    arena['owner'][ys, xs] = worms
+    arena['stamp'][ys, xs] = arena['tick']
+
+
+def addArenaApples(arena):
+    # Put apples on random free cells until there are ARENAAPPLES of them.
+    # Apples that land on a worm or another apple are tried again next tick
+    missing = ARENAAPPLES - arena['numApples']
+    if missing <= 0:
+        return
+    rng = arena['random']
+    cells = numpy.unique(rng.integers(0, ARENAWIDTH * ARENAHEIGHT, missing))
+    xs = cells % ARENAWIDTH
+    ys = cells // ARENAWIDTH
+    free = isArenaFree(arena, xs, ys) & ~arena['apples'][ys, xs]
+    arena['apples'][ys[free], xs[free]] = True
+    arena['numApples'] += int(free.sum())
+
+
+def drawArena(arena, viewx, viewy):
+    # Draw the ARENAVIEWWIDTH x ARENAVIEWHEIGHT cells with (viewx, viewy) at
+    # the top left, by writing their colors into a small array with one
+    # pixel per cell and scaling it up to the window in one go
+    rows = slice(viewy, viewy + ARENAVIEWHEIGHT)
+    columns = slice(viewx, viewx + ARENAVIEWWIDTH)
+    ys, xs = numpy.mgrid[rows, columns]
+    occupied = isArenaOccupied(arena, xs, ys)
+    # Color 0 is the background, 1 an apple and the rest the worms' colors
+    colorIndexes = numpy.where(
+        occupied, 2 + arena['owner'][rows, columns] % len(ARENACOLORS),
+        arena['apples'][rows, columns])
+    palette = numpy.array((BGCOLOR, RED) + ARENACOLORS, dtype=numpy.uint8)
+    viewSurf = pygame.Surface((ARENAVIEWWIDTH, ARENAVIEWHEIGHT))
+    pygame.surfarray.blit_array(viewSurf, palette[colorIndexes.T])
+    pygame.transform.scale(viewSurf, (WINDOWWIDTH, WINDOWHEIGHT),
+                           DISPLAYSURF)
+
+
+def runArena():
+    # Show the arena, running its ticks on the same fixed timestep as the
+    # normal game. The arrow keys move the view
+    arena = newArena()
+    viewx = (ARENAWIDTH - ARENAVIEWWIDTH) // 2
+    viewy = (ARENAHEIGHT - ARENAVIEWHEIGHT) // 2
+    accumulator = 0.0
+    tickTimes = collections.deque(maxlen=TICKRATE)
+    FPSCLOCK.tick()
+
+    while True:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                terminate()
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_ESCAPE:
+                    terminate()
+        keys = pygame.key.get_pressed()
+        for d, v in directions.items():
+            if any(keys[key] for key in v['maps']):
+                i = (UP, DOWN, LEFT, RIGHT).index(d)
+                viewx += ARENADX[i] * ARENAPANSPEED
+                viewy += ARENADY[i] * ARENAPANSPEED
+        viewx = max(0, min(viewx, ARENAWIDTH - ARENAVIEWWIDTH))
+        viewy = max(0, min(viewy, ARENAHEIGHT - ARENAVIEWHEIGHT))
+
+        while accumulator >= TICKLENGTH:
+            accumulator -= TICKLENGTH
+            startTime = time.perf_counter()
+            stepArena(arena)
+            tickTimes.append(time.perf_counter() - startTime)
+
+        drawArena(arena, viewx, viewy)
+        tickTime = sum(tickTimes) / len(tickTimes) if tickTimes else 0
+        statusSurf = BASICFONT.render(
+            f'{int(arena["alive"].sum())} worms, tick {arena["tick"]}, '
+            f'{tickTime * 1000:.1f}ms per tick', True, WHITE)
+        DISPLAYSURF.blit(statusSurf, (10, 10))
+        pygame.display.update()
+        accumulator += min(FPSCLOCK.tick(FPS) / 1000, MAXFRAMETIME)
+
+
+def benchmarkArena(numTicks=ARENABENCHTICKS):
+    # Step the arena as fast as possible, for load testing
+    arena = newArena(seed=0)
+    crashes = 0
+    startTime = time.perf_counter()
+    for i in range(numTicks):
+        crashes += stepArena(arena)
+    elapsed = time.perf_counter() - startTime
+    numWorms = len(arena['alive'])
+    print(f'{numWorms} worms on {ARENAWIDTH}x{ARENAHEIGHT} cells, '
+          f'{numTicks} ticks in {elapsed:.2f}s: {numTicks / elapsed:.0f} '
+          f'ticks/s, {numWorms * numTicks / elapsed:.0f} worm moves/s '
+          f'({crashes} crashes, longest worm {arena["length"].max()})')
 
 
 if __name__ == '__main__':
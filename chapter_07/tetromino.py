@@ -1,9 +1,15 @@
+import collections
 import random
 import time
 import pygame
 import sys
 from pprint import pprint  # noqa
 
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Only needed when USENUMPYBOARD is True
+
 FPS = 35
 WINDOWWIDTH = 640
 WINDOWHEIGHT = 480
@@ -14,6 +20,37 @@ BLANK = '.'
 
 MOVESIDEWAYSFREQ = 0.15
 MOVEDOWNFREQ = 0.1
+TICKLENGTH = 1 / FPS  # Seconds of game time in each headless tick
+INPUTPOLLTIME = 1     # Milliseconds between checks for input between frames
+LATENCYSAMPLES = 1000  # How many input latencies to keep for the report
+REWINDSECONDS = 10    # How far back the rewind buffer goes
+REWINDMEMORY = 4 * 1024 * 1024  # Most bytes the rewind buffer may use
+REWINDSTEP = 1        # Seconds to go back each time rewind is pressed
+
+# Set to True to store boards as NumPy arrays instead of row masks. This
+# is for stress testing with a huge BOARDWIDTH and BOARDHEIGHT: each box
+# takes one byte and complete lines are found and removed with array
+# operations. The autoplay AI only works with row mask boards.
+USENUMPYBOARD = False
+
+# Actions that can be applied to the falling piece
+MOVELEFT = 'left'
+MOVERIGHT = 'right'
+ROTATE = 'rotate'
+ROTATEBACK = 'rotateback'
+MOVEDOWN = 'down'
+HARDDROP = 'drop'
+CHEAT = 'cheat'  # Change the next piece to I
+ACTIONS = (MOVELEFT, MOVERIGHT, ROTATE, ROTATEBACK, MOVEDOWN, HARDDROP)
+
+# How the autoplay AI scores a board; the weights multiply the aggregate
+# column height, the number of holes, the bumpiness (height difference
+# between neighboring columns) and the number of lines cleared
+AIWEIGHTS = {'height': -0.51, 'holes': -0.36, 'bumpiness': -0.18,
+             'lines': 0.76}
+AICACHESIZE = 50000  # How many board evaluations the AI remembers
+LOOKAHEADBEAM = 6    # How many of the best placements the next piece tries
+AITIMELIMIT = 0.012  # Seconds the AI may think for each frame of autoplay
 
 XMARGIN = (WINDOWWIDTH - BOARDWIDTH * BOXSIZE) // 2
 TOPMARGIN = WINDOWHEIGHT - BOARDHEIGHT * BOXSIZE - 5
@@ -140,14 +177,94 @@ SHAPES = {  # 7 Shapes: S Z I O J L T
            '..O..',
            '.....']]}
 
+# The board is a dictionary with the following keys:
+#   'rows'   - A list with one int per row of the board. Bit
+#              (x + BOARDPADDING) is set when column x of that row is filled.
+#              The BOARDPADDING bits on either side of the board are always
+#              set, so they act as walls when checking for collisions.
+#   'colors' - A list of rows, each a tuple with the color index of every
+#              box in that row (board['colors'][y][x]), or BLANK. Rows are
+#              never changed, only replaced, so boards can share them.
+#   'heights' - A list with the height of the highest box in each column,
+#               counted from the bottom of the board (0 for an empty column).
+#   'dirtyRows' - A set of the rows that changed since the board was last
+#                 drawn.
+#   'shared' - True if the lists above may be shared with a copy of the
+#              board made by cloneBoard(), so they must be copied before
+#              they are changed.
+#
+# When USENUMPYBOARD is True, 'rows' and 'colors' are replaced by:
+#   'grid'   - A BOARDHEIGHT x BOARDWIDTH NumPy array of bytes, holding the
+#              color index + 1 of every box, or 0 for a blank space.
+# and 'heights' is a NumPy array.
+BOARDPADDING = TEMPLATEWIDTH
+FULLROW = (1 << (BOARDWIDTH + 2 * BOARDPADDING)) - 1
+COLUMNSMASK = (1 << BOARDWIDTH) - 1
+EMPTYROW = FULLROW ^ (COLUMNSMASK << BOARDPADDING)
+BLANKROW = (BLANK,) * BOARDWIDTH
+
+
+def compileShapes(shapes):
+    # Turn the template strings of every shape rotation into tables that
+    # only describe the filled boxes, so the game never has to scan the
+    # empty parts of a template. Each rotation becomes a dictionary with:
+    #   'cells'    - A list of the (x, y) template coordinates of each box
+    #   'rowmasks' - A list of (y, mask) pairs for each template row with
+    #                boxes in it; bit x of mask is set when column x is filled
+    #   'bounds'   - The (left, top, right, bottom) template coordinates of
+    #                the smallest rectangle that contains every box
+    #   'bottoms'  - A list of (x, y) template coordinates of the lowest box
+    #                in each column
+    #   'spawn'    - The (x, y) board coordinates a new piece starts at
+    tables = {}
+    for shape, rotations in shapes.items():
+        tables[shape] = []
+        for template in rotations:
+            cells = [(x, y) for y in range(TEMPLATEHEIGHT)
+                     for x in range(TEMPLATEWIDTH) if template[y][x] != BLANK]
+            rowmasks = []
+            for y in sorted(set(y for x, y in cells)):
+                rowmasks.append(
+                    (y, sum(1 << x for x, celly in cells if celly == y)))
+            xs = [x for x, y in cells]
+            ys = [y for x, y in cells]
+            tables[shape].append({
+                'cells': cells,
+                'rowmasks': rowmasks,
+                'bounds': (min(xs), min(ys), max(xs), max(ys)),
+                'bottoms': [(x, max(celly for cellx, celly in cells
+                                    if cellx == x))
+                            for x in sorted(set(xs))],
+                # Start it above the board (i.e. less than 0)
+                'spawn': (BOARDWIDTH // 2 - TEMPLATEWIDTH // 2, -2)})
+    return tables
+
+
+SHAPETABLES = compileShapes(SHAPES)
+
+if numpy is not None:
+    # The templates as arrays of booleans, for checking NumPy boards
+    SHAPEARRAYS = {
+        shape: [numpy.array([[box != BLANK for box in row]
+                             for row in template])
+                for template in rotations]
+        for shape, rotations in SHAPES.items()}
+
+TEXTSURFS = {}  # Rendered text surfaces, see renderText()
+
 
 def main():
-    global FPSCLOCK, DISPLAYSURF, BASICFONT, BIGFONT
+    global FPSCLOCK, DISPLAYSURF, BASICFONT, BIGFONT, BOXSPRITES, \
+           GHOSTSPRITES, BOARDSURF, BACKGROUNDSURF
     pygame.init()
     FPSCLOCK = pygame.time.Clock()
     DISPLAYSURF = pygame.display.set_mode((WINDOWWIDTH, WINDOWHEIGHT))
     BASICFONT = pygame.font.Font('freesansbold.ttf', 18)
     BIGFONT = pygame.font.Font('freesansbold.ttf', 100)
+    BOXSPRITES = makeBoxSprites()
+    GHOSTSPRITES = makeGhostSprites()
+    BOARDSURF = pygame.Surface((BOARDWIDTH * BOXSIZE, BOARDHEIGHT * BOXSIZE))
+    BACKGROUNDSURF = makeBackgroundSurf()
     pygame.display.set_caption('Tetromino')
 
     showTextScreen('Tetromino')
@@ -164,31 +281,20 @@ def main():
 
 def runGame():
     # Set up variables for the start of the game
-    board = getBlankBoard()
-    lastMoveDownTime = time.time()
-    lastMoveSidewaysTime = time.time()
-    lastFallTime = time.time()
-    movingDown = False  # Note: There is no movingUp variable
-    movingLeft = False
-    movingRight = False
-    score = 0
-    level, fallFreq = calculateLevelAndFallFreq(score)
-
-    fallingPiece = getNewPiece()
-    nextPiece = getNewPiece()
-
-    while True:  # Main Game Loop
-        if not fallingPiece:
-            # No falling piece is in play, so start a new piece at the top
-            fallingPiece = nextPiece
-            nextPiece = getNewPiece()
-            lastFallTime = time.time()  # Reset lastFallTime
-
-            if not isValidPosition(board, fallingPiece):
-                return  # Can't fit a new piece on the board, so game over
-
-        checkForQuit()
-        for event in pygame.event.get():  # Event Handling Loop
+    game = newGame()
+    keyInput = newKeyInput()
+    rewind = newRewindBuffer()
+    autoplay = False   # If the AI is playing
+    aiPlan = []        # The actions the AI still has to make
+    aiPiece = None     # The piece the plan is for
+    aiExpected = None  # Where the AI expects the piece to be
+    aiFallen = 0       # Rows the piece fell that the plan didn't expect
+    aiCache = {}
+    FPSCLOCK.tick()  # Don't count the time spent before the game started
+
+    while not game['gameOver']:  # Main Game Loop
+        collectEvents(keyInput)
+        for eventTime, event in keyInput['events']:  # Event Handling Loop
             if event.type == pygame.KEYUP:
                 if event.key == pygame.K_p:
                     # Pause the game
@@ -196,101 +302,574 @@ def runGame():
                     pygame.mixer.music.stop()
                     showTextScreen('Paused')  # Pause until a key press
                     pygame.mixer.music.play(-1, 0.0)
-                    lastFallTime = time.time()
-                    lastMoveDownTime = time.time()
-                    lastMoveSidewaysTime = time.time()
+                    FPSCLOCK.tick()  # Gravity doesn't run while paused
+                    restartRepeats(keyInput)
                 elif event.key in [pygame.K_LEFT, pygame.K_a]:
-                    movingLeft = False
+                    stopRepeat(keyInput, MOVELEFT)
                 elif event.key in [pygame.K_RIGHT, pygame.K_d]:
-                    movingRight = False
+                    stopRepeat(keyInput, MOVERIGHT)
                 elif event.key in [pygame.K_DOWN, pygame.K_s]:
-                    movingDown = False
+                    stopRepeat(keyInput, MOVEDOWN)
 
             elif event.type == pygame.KEYDOWN:
                 # Moving the block sideways
                 if (event.key in [pygame.K_LEFT, pygame.K_a] and
-                        isValidPosition(board, fallingPiece, adjX=-1)):
-                    fallingPiece['x'] -= 1
-                    movingLeft = True
-                    movingRight = False
-                    lastMoveSidewaysTime = time.time()
+                        applyKeyAction(game, keyInput, MOVELEFT, eventTime)):
+                    startRepeat(keyInput, MOVELEFT, eventTime)
+                    stopRepeat(keyInput, MOVERIGHT)
                 elif (event.key in [pygame.K_RIGHT, pygame.K_d] and
-                        isValidPosition(board, fallingPiece, adjX=1)):
-                    fallingPiece['x'] += 1
-                    movingRight = True
-                    movingLeft = False
-                    lastMoveSidewaysTime = time.time()
+                        applyKeyAction(game, keyInput, MOVERIGHT, eventTime)):
+                    startRepeat(keyInput, MOVERIGHT, eventTime)
+                    stopRepeat(keyInput, MOVELEFT)
 
                 # Rotating the block (if there is room to rotate)
                 elif event.key in [pygame.K_UP, pygame.K_w]:
-                    r0 = fallingPiece['rotation']
-                    fallingPiece['rotation'] = (
-                        (r0 + 1) % len(SHAPES[fallingPiece['shape']]))
-                    if not isValidPosition(board, fallingPiece):
-                        fallingPiece['rotation'] = r0
+                    applyKeyAction(game, keyInput, ROTATE, eventTime)
                 elif event.key == pygame.K_q:  # Rotating the other way
-                    r0 = fallingPiece['rotation']
-                    fallingPiece['rotation'] = (
-                        (r0 - 1) % len(SHAPES[fallingPiece['shape']]))
-                    if not isValidPosition(board, fallingPiece):
-                        fallingPiece['rotation'] = r0
+                    applyKeyAction(game, keyInput, ROTATEBACK, eventTime)
 
                 # Making the block fall faster with the down key
                 elif event.key in [pygame.K_DOWN, pygame.K_s]:
-                    movingDown = True
-                    if isValidPosition(board, fallingPiece, adjY=1):
-                        fallingPiece['y'] += 1
-                    lastMoveDownTime = time.time()
+                    applyKeyAction(game, keyInput, MOVEDOWN, eventTime)
+                    startRepeat(keyInput, MOVEDOWN, eventTime)
                 # Move the current block all the way down
                 elif event.key == pygame.K_SPACE:
-                    movingDown = False
-                    movingLeft = False
-                    movingRight = False
-                    for i in range(1, BOARDHEIGHT):
-                        if not isValidPosition(board, fallingPiece, adjY=i):
-                            break
-                    fallingPiece['y'] += i - 1
+                    keyInput['repeats'].clear()
+                    applyKeyAction(game, keyInput, HARDDROP, eventTime)
                 # Cheat, by changing next piece to I
                 elif event.key == pygame.K_c:
-                    nextPiece = getNewPiece('I')
-
-        # Handle moving the block because of user input
-        if ((movingLeft or movingRight) and
-                time.time() - lastMoveSidewaysTime > MOVESIDEWAYSFREQ):
-            if movingLeft and isValidPosition(board, fallingPiece, adjX=-1):
-                fallingPiece['x'] -= 1
-            elif movingRight and isValidPosition(board, fallingPiece, adjX=1):
-                fallingPiece['x'] += 1
-            lastMoveSidewaysTime = time.time()
-        if all((movingDown, time.time() - lastMoveDownTime > MOVEDOWNFREQ,
-                isValidPosition(board, fallingPiece, adjY=1))):
-            fallingPiece['y'] += 1
-            lastMoveDownTime = time.time()
-
-        # Let the piece fall if it is time to fall
-        if time.time() - lastFallTime > fallFreq:
-            # See if the piece has landed
-            if not isValidPosition(board, fallingPiece, adjY=1):
-                # Falling piece has landed; set it on the board
-                addToBoard(board, fallingPiece)
-                score += removeCompleteLines(board)
-                level, fallFreq = calculateLevelAndFallFreq(score)
-                fallingPiece = None
+                    applyAction(game, CHEAT)
+                # Let the AI take over (or give control back)
+                elif event.key == pygame.K_TAB:
+                    autoplay = not autoplay
+                    aiExpected = None
+                # Go back in time
+                elif event.key == pygame.K_BACKSPACE:
+                    game = rewindGame(rewind, game, REWINDSTEP)
+                    keyInput['repeats'].clear()
+                    aiExpected = None
+        keyInput['events'].clear()
+
+        # Handle moving the block because of keys being held down
+        applyRepeats(game, keyInput)
+
+        # Let the AI make one move per frame. It plans again for each new
+        # piece, or when the piece isn't where the plan expects. A piece
+        # that only fell keeps its plan, skipping the moves down that
+        # gravity already made
+        if autoplay and game['fallingPiece']:
+            piece = game['fallingPiece']
+            x, y, rotation = getPieceState(piece)
+            if (piece is not aiPiece or aiExpected is None or
+                    (x, rotation) != (aiExpected[0], aiExpected[2]) or
+                    y < aiExpected[1]):
+                aiPlan = chooseMove(game, cache=aiCache,
+                                    timeLimit=AITIMELIMIT)
+                aiPiece = piece
+                aiFallen = 0
             else:
-                # Piece did not land; just move the block down
-                fallingPiece['y'] += 1
-                lastFallTime = time.time()
+                aiFallen += y - aiExpected[1]
+            while aiPlan and aiPlan[0] == MOVEDOWN and aiFallen:
+                aiPlan.pop(0)
+                aiFallen -= 1
+            if aiPlan:
+                applyAction(game, aiPlan.pop(0))
+            aiExpected = getPieceState(piece)
+
+        # Let the engine apply gravity for the time that has passed
+        stepGame(game, dt=FPSCLOCK.get_time() / 1000)
+        recordSnapshot(rewind, game)
 
         # Drawing everything on the screen
-        DISPLAYSURF.fill(BGCOLOR)
-        drawBoard(board)
-        drawStatus(score, level)
-        drawNextPiece(nextPiece)
-        if fallingPiece:
-            drawPiece(fallingPiece)
+        DISPLAYSURF.blit(BACKGROUNDSURF, (0, 0))
+        drawBoard(game['board'])
+        drawStatus(game['score'], game['level'])
+        drawNextPiece(game['nextPiece'])
+        if game['fallingPiece']:
+            drawGhostPiece(game['board'], game['fallingPiece'])
+            drawPiece(game['fallingPiece'])
 
         pygame.display.update()
-        FPSCLOCK.tick(FPS)
+        waitForNextFrame(keyInput)
+
+    printLatencyReport(keyInput)
+
+
+def newKeyInput():
+    # Return the state of the keyboard input layer. Events are collected
+    # with the time they arrived (see waitForNextFrame()), and held keys
+    # repeat on a schedule that starts when the key was pressed, so moves
+    # don't depend on when frames happen to be drawn
+    return {
+        'events': [],   # (time, event) tuples waiting to be handled
+        'repeats': {},  # Maps held actions to the time of their next repeat
+        'latencies': collections.deque(maxlen=LATENCYSAMPLES),
+        'nextFrameTime': time.perf_counter()}
+
+
+def collectEvents(keyInput):
+    # Move the waiting pygame events into keyInput['events'], along with
+    # the time they were collected
+    now = time.perf_counter()
+    for event in pygame.event.get():
+        if event.type == pygame.QUIT or (
+                event.type == pygame.KEYUP and event.key == pygame.K_ESCAPE):
+            terminate()
+        keyInput['events'].append((now, event))
+
+
+def waitForNextFrame(keyInput):
+    # Wait until it is time for the next frame like FPSCLOCK.tick(FPS),
+    # but keep collecting events while waiting so their times are accurate
+    # to about INPUTPOLLTIME milliseconds instead of a whole frame
+    keyInput['nextFrameTime'] += 1 / FPS
+    while True:
+        collectEvents(keyInput)
+        timeLeft = keyInput['nextFrameTime'] - time.perf_counter()
+        if timeLeft <= 0:
+            break
+        pygame.time.wait(min(INPUTPOLLTIME, int(timeLeft * 1000)))
+    if timeLeft < -1 / FPS:
+        # This frame ran late; don't rush the next ones to catch up
+        keyInput['nextFrameTime'] = time.perf_counter()
+    FPSCLOCK.tick()
+
+
+def applyKeyAction(game, keyInput, action, dueTime):
+    # Apply the action and record how long after dueTime (when the key was
+    # pressed or the repeat was due) it happened
+    moved = applyAction(game, action)
+    keyInput['latencies'].append(time.perf_counter() - dueTime)
+    return moved
+
+
+def startRepeat(keyInput, action, pressTime):
+    freq = MOVEDOWNFREQ if action == MOVEDOWN else MOVESIDEWAYSFREQ
+    keyInput['repeats'][action] = pressTime + freq
+
+
+def stopRepeat(keyInput, action):
+    keyInput['repeats'].pop(action, None)
+
+
+def restartRepeats(keyInput):
+    # Start the held keys' repeat schedules over, such as after a pause
+    now = time.perf_counter()
+    for action in keyInput['repeats']:
+        startRepeat(keyInput, action, now)
+
+
+def applyRepeats(game, keyInput):
+    # Apply every repeat of a held key that came due since the last frame,
+    # in the order they came due
+    repeats = keyInput['repeats']
+    now = time.perf_counter()
+    while repeats:
+        action = min(repeats, key=repeats.get)
+        dueTime = repeats[action]
+        if dueTime > now:
+            break
+        applyKeyAction(game, keyInput, action, dueTime)
+        startRepeat(keyInput, action, dueTime)
+
+
+def getLatencyPercentiles(keyInput, percentiles=(50, 90, 99)):
+    # Return a dictionary mapping each percentile to the input-to-move
+    # latency in milliseconds
+    latencies = sorted(keyInput['latencies'])
+    if not latencies:
+        return {}
+    return {percentile: latencies[min(len(latencies) - 1,
+                                      len(latencies) * percentile // 100)]
+            * 1000 for percentile in percentiles}
+
+
+def printLatencyReport(keyInput):
+    percentiles = getLatencyPercentiles(keyInput)
+    if percentiles:
+        print('Input latency: ' + ', '.join(
+            f'p{percentile} {latency:.1f}ms'
+            for percentile, latency in percentiles.items()))
+
+
+def newGame(seed=None):
+    # Return the state of a new game. Everything that happens in a game
+    # only depends on the seed and the actions passed to stepGame(), so
+    # the same seed and actions always play out the same game, with no
+    # window or real time needed
+    rng = random.Random(seed)
+    level, fallFreq = calculateLevelAndFallFreq(0)
+    return {
+        'board': getBlankBoard(),
+        'random': rng,
+        'fallingPiece': getNewPiece(rng=rng),
+        'nextPiece': getNewPiece(rng=rng),
+        'score': 0,
+        'level': level,
+        'fallFreq': fallFreq,
+        'piecesPlaced': 0,
+        'piecesDealt': 2,     # Pieces taken from the random number generator
+        'ticks': 0,
+        'time': 0.0,          # Seconds of game time that have passed
+        'lastFallTime': 0.0,  # Game time when the piece last fell
+        'gameOver': False}
+
+
+def dealPiece(game, shape=None):
+    # Return a new piece from the game's random number generator
+    game['piecesDealt'] += 1
+    return getNewPiece(shape, rng=game['random'])
+
+
+def cloneGame(game, rng=None):
+    # Return a copy of the game state that plays on independently of the
+    # original. Only the dictionaries are copied; the board shares its rows
+    # with the original (see cloneBoard()). If rng is given, the copy uses
+    # it instead of a copy of the game's random number generator
+    clone = dict(game)
+    clone['board'] = cloneBoard(game['board'])
+    for key in ('fallingPiece', 'nextPiece'):
+        if game[key]:
+            clone[key] = dict(game[key])
+    if rng is None:
+        rng = random.Random()
+        rng.setstate(game['random'].getstate())
+    clone['random'] = rng
+    return clone
+
+
+def newRewindBuffer(seconds=REWINDSECONDS, maxBytes=REWINDMEMORY):
+    # Return a buffer that keeps snapshots of the last few seconds of a
+    # game. Snapshots share every row that didn't change between them, so
+    # each one only costs the rows that changed and a few small lists
+    return {
+        'snapshots': collections.deque(),  # {'game': ..., 'bytes': ...}
+        'seconds': seconds,
+        'maxBytes': maxBytes,
+        'bytes': 0}  # Bytes used by all of the snapshots
+
+
+def getSnapshotBytes(game, previousGame=None):
+    # Return roughly how many bytes the snapshot uses that aren't shared
+    # with the previous snapshot
+    size = sys.getsizeof(game) + sum(
+        sys.getsizeof(game[key]) for key in ('fallingPiece', 'nextPiece'))
+    board = game['board']
+    previousBoard = previousGame['board'] if previousGame else {}
+    size += sys.getsizeof(board) + sys.getsizeof(board['dirtyRows'])
+    for key in ('rows', 'colors', 'heights', 'grid'):
+        if key in board and board[key] is not previousBoard.get(key):
+            size += sys.getsizeof(board[key])
+    if 'colors' in board and board['colors'] is not previousBoard.get(
+            'colors'):
+        previousRows = set(map(id, previousBoard.get('colors', ())))
+        size += sum(sys.getsizeof(row) + sys.getsizeof(rowMask)
+                    for row, rowMask in zip(board['colors'], board['rows'])
+                    if id(row) not in previousRows)
+    if not previousGame or game['random'] is not previousGame['random']:
+        state = game['random'].getstate()
+        size += sys.getsizeof(state[1]) + len(state[1]) * sys.getsizeof(
+            2 ** 31)
+    return size
+
+
+def recordSnapshot(rewind, game):
+    # Add a snapshot of the game to the rewind buffer, and forget the
+    # snapshots that are too old or don't fit in the buffer's memory
+    snapshots = rewind['snapshots']
+    previous = snapshots[-1]['game'] if snapshots else None
+    rng = None
+    if previous and previous['piecesDealt'] == game['piecesDealt']:
+        rng = previous['random']  # No pieces dealt; share the old state
+    snapshot = cloneGame(game, rng)
+    size = getSnapshotBytes(snapshot, previous)
+    snapshots.append({'game': snapshot, 'bytes': size})
+    rewind['bytes'] += size
+
+    while len(snapshots) > 1 and (
+            rewind['bytes'] > rewind['maxBytes'] or
+            game['time'] - snapshots[0]['game']['time'] > rewind['seconds']):
+        rewind['bytes'] -= snapshots.popleft()['bytes']
+        # The new oldest snapshot no longer shares anything with an older
+        # one, so it now accounts for all of its memory
+        oldest = snapshots[0]
+        fullSize = getSnapshotBytes(oldest['game'])
+        rewind['bytes'] += fullSize - oldest['bytes']
+        oldest['bytes'] = fullSize
+
+
+def rewindGame(rewind, game, seconds):
+    # Return the game as it was the given number of seconds of game time
+    # ago (or as far back as the buffer goes), and forget the snapshots
+    # after it
+    snapshots = rewind['snapshots']
+    if not snapshots:
+        return game
+    targetTime = game['time'] - seconds
+    while len(snapshots) > 1 and snapshots[-1]['game']['time'] > targetTime:
+        rewind['bytes'] -= snapshots.pop()['bytes']
+    restored = cloneGame(snapshots[-1]['game'])
+    restored['board']['dirtyRows'] = set(range(BOARDHEIGHT))
+    return restored
+
+
+def applyAction(game, action):
+    # Apply a single action to the falling piece and return True if the
+    # piece moved
+    board = game['board']
+    piece = game['fallingPiece']
+    if not piece:
+        return False
+    if action in (MOVELEFT, MOVERIGHT):
+        adjX = -1 if action == MOVELEFT else 1
+        if isValidPosition(board, piece, adjX=adjX):
+            piece['x'] += adjX
+            return True
+    elif action in (ROTATE, ROTATEBACK):
+        r0 = piece['rotation']
+        piece['rotation'] = ((r0 + (1 if action == ROTATE else -1)) %
+                             len(SHAPES[piece['shape']]))
+        if isValidPosition(board, piece):
+            return True
+        piece['rotation'] = r0
+    elif action == MOVEDOWN:
+        if isValidPosition(board, piece, adjY=1):
+            piece['y'] += 1
+            return True
+    elif action == HARDDROP:
+        distance = getDropDistance(board, piece)
+        piece['y'] += distance
+        return distance > 0
+    elif action == CHEAT:
+        game['nextPiece'] = dealPiece(game, 'I')
+    return False
+
+
+def stepGame(game, actions=(), dt=TICKLENGTH):
+    # Advance the game by one tick: apply the actions in order, then let
+    # the piece fall if it is time to fall
+    if game['gameOver']:
+        return
+    for action in actions:
+        applyAction(game, action)
+
+    board = game['board']
+    piece = game['fallingPiece']
+    fallFreq = game['fallFreq']
+    timeSinceFall = game['time'] - game['lastFallTime']
+    if timeSinceFall > fallFreq:
+        # See if the piece has landed
+        distance = getDropDistance(board, piece)
+        if distance == 0:
+            # Falling piece has landed; set it on the board
+            addToBoard(board, piece)
+            game['score'] += removeCompleteLines(board)
+            game['level'], game['fallFreq'] = calculateLevelAndFallFreq(
+                game['score'])
+            game['piecesPlaced'] += 1
+
+            # Start the next piece at the top
+            game['fallingPiece'] = game['nextPiece']
+            game['nextPiece'] = dealPiece(game)
+            game['lastFallTime'] = game['time']
+            if not isValidPosition(board, game['fallingPiece']):
+                # Can't fit a new piece on the board, so game over
+                game['fallingPiece'] = None
+                game['gameOver'] = True
+        elif fallFreq <= 0:
+            # At the highest levels the piece falls to the bottom at once
+            piece['y'] += distance
+            game['lastFallTime'] = game['time']
+        else:
+            # Piece did not land; move the block down one row for every
+            # fallFreq that has passed, so a slow frame doesn't slow it down
+            numRows = int(timeSinceFall / fallFreq)
+            if numRows < distance:
+                piece['y'] += numRows
+                game['lastFallTime'] += numRows * fallFreq
+            else:
+                piece['y'] += distance
+                game['lastFallTime'] = game['time']
+
+    game['ticks'] += 1
+    game['time'] += dt
+
+
+def findPlacements(board, piece):
+    # Search every position the piece can reach with the same moves and
+    # rotations a player can make, and return a dictionary that maps each
+    # (x, y, rotation) where the piece would land to the list of actions
+    # that gets it there
+    rows = board['rows']
+    shape = piece['shape']
+    numRotations = len(SHAPES[shape])
+    start = (piece['x'], piece['y'], piece['rotation'])
+    parents = {start: None}
+    queue = [start]
+    placements = {}
+    for state in queue:  # The queue grows while we go through it
+        x, y, rotation = state
+        for action, nextState in (
+                (MOVELEFT, (x - 1, y, rotation)),
+                (MOVERIGHT, (x + 1, y, rotation)),
+                (ROTATE, (x, y, (rotation + 1) % numRotations)),
+                (ROTATEBACK, (x, y, (rotation - 1) % numRotations)),
+                (MOVEDOWN, (x, y + 1, rotation))):
+            if nextState in parents:
+                continue
+            if isValidPlacement(rows, shape, nextState[2], *nextState[:2]):
+                parents[nextState] = (state, action)
+                queue.append(nextState)
+            elif action == MOVEDOWN:
+                placements[state] = None  # The piece lands here
+
+    for state in placements:
+        # Follow the parents back to the start to find the path
+        path = []
+        step = state
+        while parents[step]:
+            step, action = parents[step]
+            path.append(action)
+        path.reverse()
+        # Replace the moves down at the end of the path with a hard drop
+        while path and path[-1] == MOVEDOWN:
+            path.pop()
+        path.append(HARDDROP)
+        placements[state] = path
+    return placements
+
+
+def findDropPlacements(rows, shape):
+    # Return the (x, y, rotation) of every place the shape lands when it
+    # is rotated and moved sideways at the top and then dropped. This is
+    # quicker than findPlacements() and good enough for looking ahead
+    placements = []
+    for rotation in range(len(SHAPES[shape])):
+        left, top, right, bottom = SHAPETABLES[shape][rotation]['bounds']
+        spawny = SHAPETABLES[shape][rotation]['spawn'][1]
+        for x in range(-left, BOARDWIDTH - right):
+            if not isValidPlacement(rows, shape, rotation, x, spawny):
+                continue
+            y = spawny
+            while isValidPlacement(rows, shape, rotation, x, y + 1):
+                y += 1
+            placements.append((x, y, rotation))
+    return placements
+
+
+def placeOnRows(rows, shape, rotation, x, y):
+    # Return the row masks after the shape locks at x, y and any complete
+    # lines are removed, and the number of lines removed
+    rows = list(rows)
+    for templatey, mask in SHAPETABLES[shape][rotation]['rowmasks']:
+        if templatey + y >= 0:
+            rows[templatey + y] |= mask << (x + BOARDPADDING)
+    remaining = [row for row in rows if row != FULLROW]
+    numLinesRemoved = BOARDHEIGHT - len(remaining)
+    if numLinesRemoved:
+        rows = [EMPTYROW] * numLinesRemoved + remaining
+    return rows, numLinesRemoved
+
+
+def evaluateRows(rows, weights, cache=None):
+    # Return the AI's score for the board with the given row masks (not
+    # counting cleared lines). Scores are remembered in the cache
+    # dictionary, so a board reached again in the search isn't rescored
+    key = tuple(rows)
+    if cache is not None and key in cache:
+        return cache[key]
+
+    heights = [0] * BOARDWIDTH
+    holes = 0
+    covered = 0  # Columns that have a box somewhere above the current row
+    for y, row in enumerate(rows):
+        boxes = (row >> BOARDPADDING) & COLUMNSMASK
+        holes += bin(covered & ~boxes).count('1')
+        newTops = boxes & ~covered
+        while newTops:
+            lowestBit = newTops & -newTops
+            heights[lowestBit.bit_length() - 1] = BOARDHEIGHT - y
+            newTops ^= lowestBit
+        covered |= boxes
+    bumpiness = sum(abs(heights[x] - heights[x + 1])
+                    for x in range(BOARDWIDTH - 1))
+    score = (weights['height'] * sum(heights) +
+             weights['holes'] * holes +
+             weights['bumpiness'] * bumpiness)
+
+    if cache is not None:
+        if len(cache) >= AICACHESIZE:
+            del cache[next(iter(cache))]  # Forget the oldest score
+        cache[key] = score
+    return score
+
+
+def chooseMove(game, weights=None, cache=None, timeLimit=None):
+    # Return the list of actions that moves the falling piece to the best
+    # place the AI can find, looking one piece ahead with the next piece.
+    # If timeLimit seconds pass, it stops searching and returns the best
+    # place found so far. Returns an empty list if there is no falling
+    # piece, or if the board is a NumPy board (see USENUMPYBOARD)
+    if not game['fallingPiece'] or 'grid' in game['board']:
+        return []
+    deadline = float('inf')
+    if timeLimit is not None:
+        deadline = time.perf_counter() + timeLimit
+    if weights is None:
+        weights = AIWEIGHTS
+    piece = game['fallingPiece']
+    nextShape = game['nextPiece']['shape'] if game['nextPiece'] else None
+
+    candidates = []
+    for (x, y, rotation), path in findPlacements(
+            game['board'], piece).items():
+        if candidates and time.perf_counter() > deadline:
+            break  # Out of time, so only choose from the places scored
+        rows, lines = placeOnRows(
+            game['board']['rows'], piece['shape'], rotation, x, y)
+        score = weights['lines'] * lines + evaluateRows(rows, weights, cache)
+        candidates.append((score, rows, lines, path))
+    if not candidates:
+        return []
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    if not nextShape:
+        return candidates[0][3]
+
+    # Look ahead at where the next piece could go on the best few boards,
+    # best first
+    bestScore = None
+    bestPath = candidates[0][3]
+    for score, rows, lines, path in candidates[:LOOKAHEADBEAM]:
+        nextScores = []
+        for x, y, rotation in findDropPlacements(rows, nextShape):
+            if time.perf_counter() > deadline:
+                return bestPath
+            nextRows, nextLines = placeOnRows(rows, nextShape, rotation, x, y)
+            nextScores.append(weights['lines'] * nextLines +
+                              evaluateRows(nextRows, weights, cache))
+        if not nextScores:
+            continue  # The next piece wouldn't fit, so this loses the game
+        score = weights['lines'] * lines + max(nextScores)
+        if bestScore is None or score > bestScore:
+            bestScore = score
+            bestPath = path
+    return bestPath
+
+
+def playAIGame(seed=None, weights=None, maxPieces=None, cache=None):
+    # Let the AI play a headless game until it is lost (or maxPieces have
+    # been placed) and return the finished game state
+    game = newGame(seed)
+    if cache is None:
+        cache = {}
+    while not game['gameOver']:
+        if maxPieces is not None and game['piecesPlaced'] >= maxPieces:
+            break
+        piece = game['fallingPiece']
+        stepGame(game, chooseMove(game, weights, cache))
+        while game['fallingPiece'] is piece and not game['gameOver']:
+            stepGame(game)  # Wait for the dropped piece to lock
+    return game
 
 
 def makeTextObjs(text, font, color):
@@ -355,79 +934,225 @@ def calculateLevelAndFallFreq(score):
     return level, fallFreq
 
 
-def getNewPiece(shape=None):
-    # Return a random new piece in a random rotation and color
+def getPieceState(piece):
+    return piece['x'], piece['y'], piece['rotation']
+
+
+def getNewPiece(shape=None, rng=random):
+    # Return a random new piece in a random rotation and color, using the
+    # given random number generator
     if not shape:
-        shape = random.choice(list(SHAPES.keys()))
+        shape = rng.choice(list(SHAPES.keys()))
+    rotation = rng.randint(0, len(SHAPES[shape]) - 1)
+    spawnx, spawny = SHAPETABLES[shape][rotation]['spawn']
     newPiece = {
         'shape': shape,
-        'rotation': random.randint(0, len(SHAPES[shape]) - 1),
-        'x': BOARDWIDTH // 2 - TEMPLATEWIDTH // 2,
-        'y': -2,  # Start it above the board (i.e. less than 0)
-        'color': random.randint(0, len(COLORS)-1)}
+        'rotation': rotation,
+        'x': spawnx,
+        'y': spawny,
+        'color': rng.randint(0, len(COLORS)-1)}
     return newPiece
 
 
 def addToBoard(board, piece):
     # Fill in the board based on the piece's location, shape and rotation
-    for x in range(TEMPLATEWIDTH):
-        for y in range(TEMPLATEHEIGHT):
-            if SHAPES[piece['shape']][piece['rotation']][y][x] != BLANK:
-                board[x + piece['x']][y + piece['y']] = piece['color']
+    for x, y in SHAPETABLES[piece['shape']][piece['rotation']]['cells']:
+        boardx = x + piece['x']
+        boardy = y + piece['y']
+        if boardy < 0:
+            continue  # Boxes above the board can't be stored
+        if 'grid' in board:
+            board['grid'][boardy, boardx] = piece['color'] + 1
+        else:
+            ownBoard(board)
+            row = board['colors'][boardy]
+            board['colors'][boardy] = (
+                row[:boardx] + (piece['color'],) + row[boardx + 1:])
+            board['rows'][boardy] |= 1 << (boardx + BOARDPADDING)
+        board['heights'][boardx] = max(board['heights'][boardx],
+                                       BOARDHEIGHT - boardy)
+        board['dirtyRows'].add(boardy)
 
 
 def getBlankBoard():
     # Create and return a new blank board data structure
-    board = []
-    for i in range(BOARDWIDTH):
-        board.append([BLANK] * BOARDHEIGHT)
-    return board
-
-
-def isOnBoard(x, y):
-    return x >= 0 and x < BOARDWIDTH and y < BOARDHEIGHT
+    if USENUMPYBOARD:
+        return {
+            'grid': numpy.zeros((BOARDHEIGHT, BOARDWIDTH), dtype=numpy.uint8),
+            'heights': numpy.zeros(BOARDWIDTH, dtype=numpy.int64),
+            'dirtyRows': set(range(BOARDHEIGHT))}
+    return {
+        'rows': [EMPTYROW] * BOARDHEIGHT,
+        'colors': [BLANKROW] * BOARDHEIGHT,
+        'heights': [0] * BOARDWIDTH,
+        'dirtyRows': set(range(BOARDHEIGHT)),
+        'shared': False}
+
+
+def cloneBoard(board):
+    # Return a copy of the board. Row mask boards are copied in constant
+    # time: the copy shares the original's lists until one of the two
+    # boards is changed (see ownBoard()). NumPy boards are copied in full
+    if 'grid' in board:
+        clone = dict(board, grid=board['grid'].copy(),
+                     heights=board['heights'].copy())
+    else:
+        board['shared'] = True
+        clone = dict(board)
+    clone['dirtyRows'] = set(board['dirtyRows'])
+    return clone
+
+
+def ownBoard(board):
+    # Make sure the board's lists aren't shared before changing them. Only
+    # the lists are copied; the rows themselves can always be shared
+    if board['shared']:
+        for key in ('rows', 'colors', 'heights'):
+            board[key] = list(board[key])
+        board['shared'] = False
 
 
 def isValidPosition(board, piece, adjX=0, adjY=0):
     # Return True if the piece is within the board and not colliding
-    for x in range(TEMPLATEWIDTH):
-        for y in range(TEMPLATEHEIGHT):
-            isAboveBoard = y + piece['y'] + adjY < 0
-            if (isAboveBoard or
-                    SHAPES[piece['shape']][piece['rotation']][y][x] == BLANK):
-                continue
-            if not isOnBoard(x + piece['x'] + adjX, y + piece['y'] + adjY):
-                return False
-            if board[x + piece['x'] + adjX][y + piece['y'] + adjY] != BLANK:
-                return False
+    if 'grid' in board:
+        return isValidGridPlacement(
+            board['grid'], piece['shape'], piece['rotation'],
+            piece['x'] + adjX, piece['y'] + adjY)
+    return isValidPlacement(board['rows'], piece['shape'], piece['rotation'],
+                            piece['x'] + adjX, piece['y'] + adjY)
+
+
+def isValidPlacement(rows, shape, rotation, x, y):
+    # Return True if the shape in the given rotation fits at x, y on the
+    # board with the given row masks
+    shift = x + BOARDPADDING
+    if not 0 <= shift <= BOARDWIDTH + BOARDPADDING:
+        # Too far off the side for the walls to catch it, which only
+        # matters if part of the piece is on the board
+        shift = None
+    for templatey, mask in SHAPETABLES[shape][rotation]['rowmasks']:
+        boardy = templatey + y
+        if boardy < 0:
+            continue  # Nothing to check above the board
+        if boardy >= BOARDHEIGHT or shift is None:
+            return False
+        if rows[boardy] & (mask << shift):
+            return False  # Overlaps a filled box or one of the walls
     return True
 
 
+def isValidGridPlacement(grid, shape, rotation, x, y):
+    # Return True if the shape in the given rotation fits at x, y on the
+    # NumPy board grid, by comparing the slice of the grid under the piece
+    # with the template
+    table = SHAPETABLES[shape][rotation]
+    left, top, right, bottom = table['bounds']
+    visibleTop = max(top, -y)  # Boxes above the board aren't checked
+    if visibleTop > bottom:
+        return True
+    if y + bottom >= BOARDHEIGHT:
+        return False
+    xs = [cellx for cellx, celly in table['cells'] if celly >= visibleTop]
+    left = min(xs)
+    right = max(xs)
+    if x + left < 0 or x + right >= BOARDWIDTH:
+        return False
+    area = grid[y + visibleTop:y + bottom + 1, x + left:x + right + 1]
+    template = SHAPEARRAYS[shape][rotation][visibleTop:bottom + 1,
+                                            left:right + 1]
+    return not area[template].any()
+
+
+def getColumnHeights(rows):
+    # Return the height of each column of the board with the given row
+    # masks, by going down the rows until every column has been seen
+    heights = [0] * BOARDWIDTH
+    covered = 0  # Columns that have a box in the rows seen so far
+    for y, row in enumerate(rows):
+        newTops = (row >> BOARDPADDING) & COLUMNSMASK & ~covered
+        covered |= newTops
+        while newTops:
+            lowestBit = newTops & -newTops
+            heights[lowestBit.bit_length() - 1] = BOARDHEIGHT - y
+            newTops ^= lowestBit
+        if covered == COLUMNSMASK:
+            break
+    return heights
+
+
+def getDropDistance(board, piece):
+    # Return how many rows the piece can fall before it lands. When the
+    # piece is above the highest box in every column it covers, this only
+    # takes one check per column; otherwise (such as when it was slid under
+    # an overhang) the rows are checked one at a time
+    heights = board['heights']
+    distance = BOARDHEIGHT
+    for x, bottom in SHAPETABLES[piece['shape']][piece['rotation']]['bottoms']:
+        boardx = x + piece['x']
+        if not 0 <= boardx < BOARDWIDTH:
+            distance = None
+            break
+        # Rows between the bottom box and the top of the column
+        gap = BOARDHEIGHT - heights[boardx] - (bottom + piece['y']) - 1
+        if gap < 0:
+            distance = None
+            break
+        distance = min(distance, gap)
+    if distance is None:
+        distance = 0
+        while isValidPosition(board, piece, adjY=distance + 1):
+            distance += 1
+    return distance
+
+
 def isCompleteLine(board, y):
     # Return True if the line is filled with boxes with no gaps
-    return all(board[x][y] != BLANK for x in range(BOARDWIDTH))
+    if 'grid' in board:
+        return bool(board['grid'][y].all())
+    return board['rows'][y] == FULLROW
 
 
 def removeCompleteLines(board):
     # Remove any completed lines on the board, move everything above them
     # down, and return the number of complete lines
-    numLinesRemoved = 0
-    y = BOARDHEIGHT - 1  # Start y at the bottom of the board
-    while y >= 0:
-        if isCompleteLine(board, y):
-            # Remove the line and pull boxes down by one line
-            for pullDownY in range(y, 0, -1):
-                for x in range(BOARDWIDTH):
-                    board[x][pullDownY] = board[x][pullDownY - 1]
-            # Set the very top line to blank
-            for x in range(BOARDWIDTH):
-                board[x][0] = BLANK
-            numLinesRemoved += 1
-            # Note on the next iteration of the loop, y is the same;
-            # this is so that if the line that was pulled down is also
-            # complete, it will be removed.
-        else:
-            y -= 1  # Move on to check next row up
+    if 'grid' in board:
+        return removeCompleteGridLines(board)
+    remaining = [y for y in range(BOARDHEIGHT) if not isCompleteLine(board, y)]
+    numLinesRemoved = BOARDHEIGHT - len(remaining)
+    if numLinesRemoved:
+        # Keep the incomplete rows in order and add blank rows on top. The
+        # lists are replaced rather than changed, in case they are shared
+        for key, blank in (('rows', EMPTYROW), ('colors', BLANKROW)):
+            board[key] = ([blank] * numLinesRemoved +
+                          [board[key][y] for y in remaining])
+        board['heights'] = getColumnHeights(board['rows'])
+        # Every row down to the lowest removed line has changed
+        lowestRemoved = max(set(range(BOARDHEIGHT)) - set(remaining))
+        board['dirtyRows'].update(range(lowestRemoved + 1))
+    return numLinesRemoved
+
+
+def removeCompleteGridLines(board):
+    # removeCompleteLines() for NumPy boards. Only the rows from the top of
+    # the highest column down are looked at, since the rest are blank
+    grid = board['grid']
+    stackTop = BOARDHEIGHT - int(board['heights'].max())
+    stack = grid[stackTop:]
+    complete = stack.all(axis=1)
+    numLinesRemoved = int(numpy.count_nonzero(complete))
+    if numLinesRemoved:
+        # Pack the incomplete rows down to the bottom in one pass
+        remaining = stack[~complete]
+        grid[stackTop:stackTop + numLinesRemoved] = 0
+        grid[stackTop + numLinesRemoved:] = remaining
+
+        filled = stack != 0
+        board['heights'][:] = numpy.where(
+            filled.any(axis=0), BOARDHEIGHT - stackTop - filled.argmax(axis=0),
+            0)
+        # Every row down to the lowest removed line has changed
+        lowestRemoved = stackTop + int(numpy.flatnonzero(complete)[-1])
+        board['dirtyRows'].update(range(stackTop, lowestRemoved + 1))
     return numLinesRemoved
 
 
@@ -437,6 +1162,50 @@ def convertToPixelCoords(boxx, boxy):
     return XMARGIN + boxx * BOXSIZE, TOPMARGIN + boxy * BOXSIZE
 
 
+def makeBoxSprites():
+    # Draw one box of every color ahead of time, so drawing a box is a
+    # single blit. The sprites leave out the 1 pixel gap on the top and
+    # left of each box
+    sprites = []
+    for color in range(len(COLORS)):
+        sprite = pygame.Surface((BOXSIZE - 1, BOXSIZE - 1))
+        sprite.fill(COLORS[color])
+        sprite.fill(LIGHTCOLORS[color], (0, 0, BOXSIZE - 4, BOXSIZE - 4))
+        sprites.append(sprite)
+    return sprites
+
+
+def makeGhostSprites():
+    # Draw the outline of a box of every color, used to show where the
+    # falling piece will land
+    sprites = []
+    for color in range(len(COLORS)):
+        sprite = pygame.Surface((BOXSIZE - 1, BOXSIZE - 1))
+        sprite.fill(BGCOLOR)
+        sprite.set_colorkey(BGCOLOR)
+        pygame.draw.rect(sprite, LIGHTCOLORS[color],
+                         (0, 0, BOXSIZE - 1, BOXSIZE - 1), 2)
+        sprites.append(sprite)
+    return sprites
+
+
+def makeBackgroundSurf():
+    # Draw the parts of the screen that never change during a game
+    surf = pygame.Surface((WINDOWWIDTH, WINDOWHEIGHT))
+    surf.fill(BGCOLOR)
+    # Draw the border around the board
+    pygame.draw.rect(
+            surf, BORDERCOLOR,
+            (XMARGIN - 3, TOPMARGIN - 7, BOARDWIDTH * BOXSIZE + 8,
+             BOARDHEIGHT * BOXSIZE + 8), 5)
+    # Draw the "next" text
+    nextSurf = BASICFONT.render('Next:', True, TEXTCOLOR)
+    nextRect = nextSurf.get_rect()
+    nextRect.topleft = (WINDOWWIDTH - 120, 80)
+    surf.blit(nextSurf, nextRect)
+    return surf
+
+
 def drawBox(boxx, boxy, color, pixelx=None, pixely=None):
     # Draw a single box (each Tetromino piece has four boxes)
     # at xy coordinates on the board, or, if pixelx & pixely
@@ -446,64 +1215,77 @@ def drawBox(boxx, boxy, color, pixelx=None, pixely=None):
         return
     if not pixelx and not pixely:
         pixelx, pixely = convertToPixelCoords(boxx, boxy)
-    pygame.draw.rect(DISPLAYSURF, COLORS[color],
-                     (pixelx + 1, pixely + 1, BOXSIZE - 1, BOXSIZE - 1))
-    pygame.draw.rect(DISPLAYSURF, LIGHTCOLORS[color],
-                     (pixelx + 1, pixely + 1, BOXSIZE - 4, BOXSIZE - 4))
+    DISPLAYSURF.blit(BOXSPRITES[color], (pixelx + 1, pixely + 1))
 
 
 def drawBoard(board):
-    # Draw the border around the board
-    pygame.draw.rect(
-            DISPLAYSURF, BORDERCOLOR,
-            (XMARGIN - 3, TOPMARGIN - 7, BOARDWIDTH * BOXSIZE + 8,
-             BOARDHEIGHT * BOXSIZE + 8), 5)
-    # Fill the background of the board
-    pygame.draw.rect(
-        DISPLAYSURF, BGCOLOR,
-        (XMARGIN, TOPMARGIN, BOXSIZE * BOARDWIDTH, BOXSIZE * BOARDHEIGHT))
-    # Draw the indivitudal boxes on the board
-    for x in range(BOARDWIDTH):
-        for y in range(BOARDHEIGHT):
-            drawBox(x, y, board[x][y])
+    # Redraw the rows of the board surface that changed since the last
+    # frame, then draw the board surface on the screen
+    for y in board['dirtyRows']:
+        BOARDSURF.fill(BGCOLOR,
+                       (0, y * BOXSIZE, BOARDWIDTH * BOXSIZE, BOXSIZE))
+        if 'grid' in board:
+            rowColors = [color - 1 if color else BLANK
+                         for color in board['grid'][y].tolist()]
+        else:
+            rowColors = board['colors'][y]
+        for x, color in enumerate(rowColors):
+            if color != BLANK:
+                BOARDSURF.blit(BOXSPRITES[color],
+                               (x * BOXSIZE + 1, y * BOXSIZE + 1))
+    board['dirtyRows'].clear()
+    DISPLAYSURF.blit(BOARDSURF, (XMARGIN, TOPMARGIN))
+
+
+def renderText(text):
+    # Return a surface with the text on it. The surfaces are kept so that
+    # text that doesn't change isn't rendered again every frame
+    if text not in TEXTSURFS:
+        if len(TEXTSURFS) >= 100:
+            TEXTSURFS.clear()
+        TEXTSURFS[text] = BASICFONT.render(text, True, TEXTCOLOR)
+    return TEXTSURFS[text]
 
 
 def drawStatus(score, level):
     # Draw the score text
-    scoreSurf = BASICFONT.render(f'Score: {score}', True, TEXTCOLOR)
+    scoreSurf = renderText(f'Score: {score}')
     scoreRect = scoreSurf.get_rect()
     scoreRect.topleft = (WINDOWWIDTH - 150, 20)
     DISPLAYSURF.blit(scoreSurf, scoreRect)
 
     # Draw the level text
-    levelSurf = BASICFONT.render(f'Level: {level}', True, TEXTCOLOR)
+    levelSurf = renderText(f'Level: {level}')
     levelRect = levelSurf.get_rect()
     levelRect.topleft = (WINDOWWIDTH - 150, 50)
     DISPLAYSURF.blit(levelSurf, levelRect)
 
 
 def drawPiece(piece, pixelx=None, pixely=None):
-    shapeToDraw = SHAPES[piece['shape']][piece['rotation']]
     if not pixelx and not pixely:
         # If pixelx & pixely haven't been specified, use the location stored
         # in the piece data structure
         pixelx, pixely = convertToPixelCoords(piece['x'], piece['y'])
 
     # Draw each of the blocks that make up the piece
-    for x in range(TEMPLATEWIDTH):
-        for y in range(TEMPLATEHEIGHT):
-            if shapeToDraw[y][x] != BLANK:
-                drawBox(None, None, piece['color'],
-                        pixelx + x * BOXSIZE, pixely + y * BOXSIZE)
+    for x, y in SHAPETABLES[piece['shape']][piece['rotation']]['cells']:
+        drawBox(None, None, piece['color'],
+                pixelx + x * BOXSIZE, pixely + y * BOXSIZE)
+
+
+def drawGhostPiece(board, piece):
+    # Draw an outline of the piece where it would land if it was dropped
+    landingy = piece['y'] + getDropDistance(board, piece)
+    pixelx, pixely = convertToPixelCoords(piece['x'], landingy)
+    for x, y in SHAPETABLES[piece['shape']][piece['rotation']]['cells']:
+        if landingy + y >= 0:
+            DISPLAYSURF.blit(GHOSTSPRITES[piece['color']],
+                             (pixelx + x * BOXSIZE + 1,
+                              pixely + y * BOXSIZE + 1))
 
 
 def drawNextPiece(piece):
-    # Draw the "next" text
-    nextSurf = BASICFONT.render('Next:', True, TEXTCOLOR)
-    nextRect = nextSurf.get_rect()
-    nextRect.topleft = (WINDOWWIDTH - 120, 80)
-    DISPLAYSURF.blit(nextSurf, nextRect)
-    # Draw the "next" piece
+    # Draw the "next" piece (the "next" text is on the background)
     drawPiece(piece, pixelx=WINDOWWIDTH - 120, pixely=100)
 
 
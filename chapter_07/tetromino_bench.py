@@ -0,0 +1,125 @@
+# Runs Tetromino games headlessly (no window, no real time) and reports how
+# fast the game engine in tetromino.py can simulate them.
+#
+#   python tetromino_bench.py [number of games]
+#   python tetromino_bench.py --ai [number of games]
+#   python tetromino_bench.py --numpy [number of games]
+#   python tetromino_bench.py --clone [number of copies]
+#
+# --numpy plays on NumPy boards (see USENUMPYBOARD in tetromino.py); raise
+# BOARDWIDTH and BOARDHEIGHT there to stress test huge boards.
+import copy
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import tetromino  # noqa: E402
+
+NUMGAMES = 200
+MAXTICKS = 20000  # Stop games that go on for longer than this
+NUMAIGAMES = 5
+MAXAIPIECES = 500  # Stop AI games after this many pieces
+NUMCLONES = 10000
+
+
+def playRandomGame(seed):
+    # Play a game where every tick the piece is pushed around at random,
+    # and return the finished game state
+    game = tetromino.newGame(seed)
+    actionRng = random.Random(seed)
+    while not game['gameOver'] and game['ticks'] < MAXTICKS:
+        action = actionRng.choice(tetromino.ACTIONS)
+        tetromino.stepGame(game, (action,))
+    return game
+
+
+def benchmarkGames(numGames):
+    startTime = time.perf_counter()
+    ticks = 0
+    pieces = 0
+    for seed in range(numGames):
+        game = playRandomGame(seed)
+        ticks += game['ticks']
+        pieces += game['piecesPlaced']
+    elapsed = time.perf_counter() - startTime
+    print(f'{numGames} games, {pieces} pieces, {ticks} ticks '
+          f'in {elapsed:.2f}s')
+    print(f'{numGames / elapsed:.1f} games/s, {ticks / elapsed:.0f} ticks/s')
+
+
+def benchmarkAI(numGames):
+    # Time every decision the AI makes, since it has to fit in one frame
+    decisionTimes = []
+    lines = 0
+    pieces = 0
+    for seed in range(numGames):
+        game = tetromino.newGame(seed)
+        cache = {}
+        while not game['gameOver'] and game['piecesPlaced'] < MAXAIPIECES:
+            piece = game['fallingPiece']
+            startTime = time.perf_counter()
+            actions = tetromino.chooseMove(game, cache=cache)
+            decisionTimes.append(time.perf_counter() - startTime)
+            tetromino.stepGame(game, actions)
+            while game['fallingPiece'] is piece and not game['gameOver']:
+                tetromino.stepGame(game)
+        lines += game['score']
+        pieces += game['piecesPlaced']
+    decisionTimes.sort()
+    frameTime = 1 / tetromino.FPS
+    print(f'{numGames} AI games, {pieces} pieces, {lines} lines')
+    print(f'decision time: '
+          f'mean {sum(decisionTimes) / len(decisionTimes) * 1000:.2f}ms, '
+          f'p99 {decisionTimes[len(decisionTimes) * 99 // 100] * 1000:.2f}ms, '
+          f'max {decisionTimes[-1] * 1000:.2f}ms '
+          f'(frame is {frameTime * 1000:.1f}ms)')
+
+
+def benchmarkClones(numClones):
+    # Compare copying a game in play with cloneGame() and copy.deepcopy(),
+    # and measure how much memory a rewind buffer snapshot takes
+    game = playRandomGame(0)
+    game['gameOver'] = False
+    for name, clone in (('cloneGame', tetromino.cloneGame),
+                        ('deepcopy', copy.deepcopy)):
+        startTime = time.perf_counter()
+        for i in range(numClones):
+            clone(game)
+        elapsed = time.perf_counter() - startTime
+        print(f'{name}: {elapsed / numClones * 1e6:.1f}us per copy')
+
+    rewind = tetromino.newRewindBuffer()
+    game = tetromino.newGame(0)
+    actionRng = random.Random(0)
+    # Mostly idle ticks and no hard drops, like a person playing
+    actions = [action for action in tetromino.ACTIONS
+               if action != tetromino.HARDDROP] + [None] * 20
+    startTime = time.perf_counter()
+    while not game['gameOver'] and game['ticks'] < MAXTICKS:
+        action = actionRng.choice(actions)
+        tetromino.stepGame(game, (action,) if action else ())
+        tetromino.recordSnapshot(rewind, game)
+    elapsed = time.perf_counter() - startTime
+    numSnapshots = len(rewind['snapshots'])
+    print(f'rewind: {game["ticks"]} ticks recorded in {elapsed * 1000:.0f}ms, '
+          f'{numSnapshots} snapshots kept in {rewind["bytes"] / 1024:.0f} '
+          f'KiB ({rewind["bytes"] / numSnapshots:.0f} bytes each)')
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == '--ai':
+        benchmarkAI(int(args[1]) if len(args) > 1 else NUMAIGAMES)
+    elif args and args[0] == '--numpy':
+        tetromino.USENUMPYBOARD = True
+        benchmarkGames(int(args[1]) if len(args) > 1 else NUMGAMES)
+    elif args and args[0] == '--clone':
+        benchmarkClones(int(args[1]) if len(args) > 1 else NUMCLONES)
+    else:
+        benchmarkGames(int(args[0]) if args else NUMGAMES)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+# Hosts many headless Tetromino games in one process for remote players.
+# Each connection gets its own game from tetromino.py. Gravity for every
+# game is driven by one timer heap instead of one sleeping task per game.
+#
+#   python tetromino_server.py [--port N]         Run the server
+#   python tetromino_server.py --load N [--port N] Connect N test clients
+#
+# Clients send one byte per input, the index of the action in
+# tetromino.ACTIONS. The server sends messages made of a 1 byte type and:
+#   UPDATEMSG   - UPDATEHEADER (tick, score, level, falling piece shape,
+#                 rotation, color, x and y, next piece shape and the number
+#                 of changed rows), then for each changed row its index
+#                 and BOARDWIDTH bytes of color index + 1 (0 for blank)
+#   GAMEOVERMSG - GAMEOVERHEADER (the final score); a new game then starts
+import argparse
+import asyncio
+import collections
+import heapq
+import itertools
+import os
+import random
+import struct
+import time
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import tetromino  # noqa: E402
+
+HOST = '127.0.0.1'
+PORT = 8035
+MINTICKLENGTH = tetromino.TICKLENGTH  # Shortest time between game ticks
+REPORTFREQ = 5        # Seconds between server reports
+LATENCYSAMPLES = 10000
+MAXWRITEBUFFER = 1 << 16  # Disconnect clients that stop reading
+LOADINPUTFREQ = 0.1   # Seconds between inputs from each test client
+
+UPDATEMSG = 1
+GAMEOVERMSG = 2
+UPDATEHEADER = struct.Struct('!IHBBBBbbBB')
+GAMEOVERHEADER = struct.Struct('!H')
+ROWHEADER = struct.Struct('!B')
+SHAPENAMES = list(tetromino.SHAPES.keys())
+
+# The server is a dictionary with the keys:
+#     'timers' - A heap of (due time, sequence number, session) tuples, one
+#                for every session's next game tick
+#     'wakeUp' - An asyncio.Event set when a timer is added before the
+#                earliest one, so the scheduler doesn't oversleep
+#     'sessions' - A dictionary of the connected sessions by their id
+#     'latencies' - How late recent ticks ran, in seconds
+#     'counter' - Numbers the timers, so equal due times never compare sessions
+#
+# Each session is a dictionary with the keys:
+#     'id' - A number that identifies the session
+#     'game' - The tetromino.newGame() state
+#     'writer' - The asyncio.StreamWriter for the connection
+#     'lastTickTime' - The loop time of the last game tick
+#     'open' - False once the client disconnected
+
+
+def newServer():
+    return {'timers': [], 'wakeUp': asyncio.Event(), 'sessions': {},
+            'latencies': collections.deque(maxlen=LATENCYSAMPLES),
+            'counter': itertools.count()}
+
+
+def scheduleTick(server, session, dueTime):
+    timers = server['timers']
+    if not timers or dueTime < timers[0][0]:
+        server['wakeUp'].set()
+    heapq.heappush(timers, (dueTime, next(server['counter']), session))
+
+
+def getTickLength(game):
+    return max(game['fallFreq'], MINTICKLENGTH)
+
+
+def encodeUpdate(game):
+    # Return an update message with the rows that changed since the last
+    # message, taking the place of drawBoard() for the board's dirtyRows
+    board = game['board']
+    piece = game['fallingPiece']
+    rows = sorted(board['dirtyRows'])
+    board['dirtyRows'].clear()
+    parts = [bytes([UPDATEMSG]), UPDATEHEADER.pack(
+        game['ticks'] & 0xFFFFFFFF, min(game['score'], 0xFFFF),
+        min(game['level'], 0xFF), SHAPENAMES.index(piece['shape']),
+        piece['rotation'], piece['color'], piece['x'], piece['y'],
+        SHAPENAMES.index(game['nextPiece']['shape']), len(rows))]
+    for y in rows:
+        parts.append(ROWHEADER.pack(y))
+        parts.append(bytes(0 if color == tetromino.BLANK else color + 1
+                           for color in board['colors'][y]))
+    return b''.join(parts)
+
+
+def sendUpdate(session):
+    writer = session['writer']
+    if writer.transport.get_write_buffer_size() > MAXWRITEBUFFER:
+        session['open'] = False
+        writer.close()
+        return
+    game = session['game']
+    if game['gameOver']:
+        writer.write(bytes([GAMEOVERMSG]) +
+                     GAMEOVERHEADER.pack(min(game['score'], 0xFFFF)))
+        session['game'] = game = tetromino.newGame()
+    writer.write(encodeUpdate(game))
+
+
+async def runScheduler(server):
+    # Run the game ticks of every session as they come due
+    loop = asyncio.get_running_loop()
+    timers = server['timers']
+    while True:
+        server['wakeUp'].clear()
+        if timers:
+            delay = timers[0][0] - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(server['wakeUp'].wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+        else:
+            await server['wakeUp'].wait()
+            continue
+
+        now = loop.time()
+        while timers and timers[0][0] <= now:
+            dueTime, count, session = heapq.heappop(timers)
+            if not session['open']:
+                continue
+            server['latencies'].append(now - dueTime)
+            game = session['game']
+            tetromino.stepGame(game, dt=now - session['lastTickTime'])
+            session['lastTickTime'] = now
+            sendUpdate(session)
+            scheduleTick(server, session, now + getTickLength(game))
+        await asyncio.sleep(0)  # Let the connections read and write
+
+
+async def handleClient(server, reader, writer):
+    loop = asyncio.get_running_loop()
+    session = {'id': next(server['counter']), 'game': tetromino.newGame(),
+               'writer': writer, 'lastTickTime': loop.time(), 'open': True}
+    server['sessions'][session['id']] = session
+    sendUpdate(session)
+    scheduleTick(server, session,
+                 loop.time() + getTickLength(session['game']))
+    try:
+        while session['open']:
+            data = await reader.read(64)
+            if not data:
+                break
+            for code in data:
+                if code < len(tetromino.ACTIONS):
+                    tetromino.applyAction(session['game'],
+                                          tetromino.ACTIONS[code])
+            sendUpdate(session)
+    except ConnectionError:
+        pass
+    finally:
+        session['open'] = False
+        server['sessions'].pop(session['id'], None)
+        writer.close()
+
+
+async def reportStats(server):
+    # Print the tick latency and how many sessions one core could run
+    lastWallTime = time.perf_counter()
+    lastCpuTime = time.process_time()
+    while True:
+        await asyncio.sleep(REPORTFREQ)
+        wallTime = time.perf_counter()
+        cpuTime = time.process_time()
+        cpuUse = (cpuTime - lastCpuTime) / (wallTime - lastWallTime)
+        lastWallTime, lastCpuTime = wallTime, cpuTime
+
+        latencies = sorted(server['latencies'])
+        server['latencies'].clear()
+        numSessions = len(server['sessions'])
+        if not latencies:
+            print(f'{numSessions} sessions, no ticks')
+            continue
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[len(latencies) * 99 // 100] * 1000
+        perCore = numSessions / cpuUse if cpuUse else 0
+        print(f'{numSessions} sessions, {len(latencies) / REPORTFREQ:.0f} '
+              f'ticks/s, tick latency p50 {p50:.2f}ms p99 {p99:.2f}ms, '
+              f'CPU {cpuUse * 100:.0f}% (~{perCore:.0f} sessions/core)')
+
+
+async def serve(host, port):
+    server = newServer()
+    listener = await asyncio.start_server(
+        lambda reader, writer: handleClient(server, reader, writer),
+        host, port)
+    print(f'Serving Tetromino on {host}:{port}')
+    async with listener:
+        await asyncio.gather(runScheduler(server), reportStats(server),
+                             listener.serve_forever())
+
+
+async def runLoadClient(host, port, stats):
+    # A test client that reads every message and sends a random input
+    # every LOADINPUTFREQ seconds
+    reader, writer = await asyncio.open_connection(host, port)
+
+    async def readMessages():
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                return
+            stats['bytes'] += len(data)
+
+    readTask = asyncio.create_task(readMessages())
+    try:
+        while not readTask.done():
+            await asyncio.sleep(LOADINPUTFREQ * random.uniform(0.5, 1.5))
+            writer.write(bytes([random.randrange(len(tetromino.ACTIONS))]))
+            stats['inputs'] += 1
+    finally:
+        writer.close()
+
+
+async def runLoad(host, port, numClients):
+    stats = {'bytes': 0, 'inputs': 0}
+    tasks = [asyncio.create_task(runLoadClient(host, port, stats))
+             for i in range(numClients)]
+    print(f'Connected {numClients} test clients to {host}:{port}')
+    while True:
+        await asyncio.sleep(REPORTFREQ)
+        print(f'{stats["inputs"] / REPORTFREQ:.0f} inputs/s sent, '
+              f'{stats["bytes"] / REPORTFREQ / 1024:.0f} KiB/s received')
+        stats['bytes'] = stats['inputs'] = 0
+        if all(task.done() for task in tasks):
+            return
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Host many headless Tetromino games.')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--load', type=int, metavar='N',
+                        help='connect N test clients instead of serving')
+    args = parser.parse_args()
+    try:
+        if args.load:
+            asyncio.run(runLoad(args.host, args.port, args.load))
+        else:
+            asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
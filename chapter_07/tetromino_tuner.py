@@ -0,0 +1,117 @@
+# Tunes the weights the Tetromino AI uses to score boards, by playing
+# batches of seeded headless games on every CPU core and keeping the
+# weights that clear the most lines (the cross-entropy method).
+#
+#   python tetromino_tuner.py [--workers N] [--generations N] ...
+import argparse
+import concurrent.futures
+import os
+import random
+import time
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import tetromino  # noqa: E402
+
+GENERATIONS = 10
+POPULATION = 24      # Sets of weights tried in each generation
+# Fraction of the best weights the next generation is sampled around
+ELITEFRACTION = 0.25
+GAMESPERWEIGHTS = 4  # Games played with each set of weights
+MAXPIECES = 300      # Stop games after this many pieces
+STARTDEVIATION = 0.5
+MINDEVIATION = 0.02  # Keeps the search from collapsing too early
+
+
+def playJob(job):
+    # Play one game with the given weights and seed, and return the lines
+    # cleared and pieces placed. This runs in the worker processes
+    weights, seed, maxPieces = job
+    game = tetromino.playAIGame(seed, weights, maxPieces)
+    return game['score'], game['piecesPlaced']
+
+
+def sampleWeights(rng, means, deviations):
+    return {name: rng.gauss(means[name], deviations[name]) for name in means}
+
+
+def tune(workers=None, generations=GENERATIONS, population=POPULATION,
+         gamesPerWeights=GAMESPERWEIGHTS, maxPieces=MAXPIECES, seed=0):
+    # Run the cross-entropy method and return the best weights found
+    rng = random.Random(seed)
+    means = dict(tetromino.AIWEIGHTS)
+    deviations = {name: STARTDEVIATION for name in means}
+    numElite = max(1, int(population * ELITEFRACTION))
+    best = (None, means)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        print(f'Tuning with {workers} worker processes')
+        for generation in range(generations):
+            candidates = [sampleWeights(rng, means, deviations)
+                          for i in range(population)]
+            # Every candidate plays the same seeds, so they are compared
+            # on the same pieces
+            seeds = [rng.randrange(2**32) for i in range(gamesPerWeights)]
+            jobs = [(weights, gameSeed, maxPieces)
+                    for weights in candidates for gameSeed in seeds]
+
+            startTime = time.perf_counter()
+            chunksize = max(1, len(jobs) // (workers * 4))
+            results = list(pool.map(playJob, jobs, chunksize=chunksize))
+            elapsed = time.perf_counter() - startTime
+
+            scored = []
+            for i, weights in enumerate(candidates):
+                games = results[i * gamesPerWeights:(i + 1) * gamesPerWeights]
+                lines = sum(result[0] for result in games) / len(games)
+                pieces = sum(result[1] for result in games) / len(games)
+                scored.append((lines, pieces, weights))
+            scored.sort(key=lambda result: result[:2], reverse=True)
+            if best[0] is None or scored[0][:2] > best[0]:
+                best = (scored[0][:2], scored[0][2])
+
+            # Fit the next generation to the best candidates
+            elite = [weights for lines, pieces, weights in scored[:numElite]]
+            for name in means:
+                values = [weights[name] for weights in elite]
+                means[name] = sum(values) / len(values)
+                variance = sum((value - means[name]) ** 2
+                               for value in values) / len(values)
+                deviations[name] = max(variance ** 0.5, MINDEVIATION)
+
+            totalPieces = sum(result[1] for result in results)
+            eliteLines = sum(result[0] for result in scored[:numElite])
+            print(f'Generation {generation + 1}: '
+                  f'best {scored[0][0]:.1f} lines, '
+                  f'elite mean {eliteLines / numElite:.1f} lines | '
+                  f'{len(jobs) / elapsed:.2f} games/s, '
+                  f'{totalPieces / elapsed:.0f} pieces/s')
+
+    print('Best weights:', formatWeights(best[1]))
+    return best[1]
+
+
+def formatWeights(weights):
+    return '{' + ', '.join(f'{name!r}: {value:.3f}'
+                           for name, value in weights.items()) + '}'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Tune the Tetromino AI weights with self-play.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--generations', type=int, default=GENERATIONS)
+    parser.add_argument('--population', type=int, default=POPULATION)
+    parser.add_argument('--games', type=int, default=GAMESPERWEIGHTS,
+                        help='games played with each set of weights')
+    parser.add_argument('--max-pieces', type=int, default=MAXPIECES)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    tune(args.workers, args.generations, args.population, args.games,
+         args.max_pieces, args.seed)
+
+
+if __name__ == '__main__':
+    main()
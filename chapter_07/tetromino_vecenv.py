@@ -0,0 +1,248 @@
+# A batched version of the Tetromino rules for training bots: many
+# independent boards are stored in one NumPy array and stepped together,
+# so moving, rotating, dropping, locking and removing lines are a handful
+# of array operations for all of the boards at once. Finished games are
+# reset automatically.
+#
+#   python tetromino_vecenv.py [number of boards] [number of steps]
+import os
+import sys
+import time
+
+import numpy
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import tetromino  # noqa: E402
+from tetromino import BOARDWIDTH, BOARDHEIGHT  # noqa: E402
+
+NUMBOARDS = 4096
+NUMSTEPS = 200
+
+# Actions, one per board per step
+NOOP = 0
+MOVELEFT = 1
+MOVERIGHT = 2
+ROTATE = 3
+ROTATEBACK = 4
+MOVEDOWN = 5
+HARDDROP = 6
+NUMACTIONS = 7
+
+SHAPENAMES = list(tetromino.SHAPES.keys())
+NUMROTATIONS = numpy.array([len(tetromino.SHAPES[shape])
+                            for shape in SHAPENAMES])
+MAXROTATIONS = int(NUMROTATIONS.max())
+# CELLOFFSETS[shape, rotation] is a 4 x 2 array with the (x, y) template
+# coordinates of each box. Shapes with fewer rotations repeat them, so any
+# rotation index up to MAXROTATIONS can be looked up.
+CELLOFFSETS = numpy.array([
+    [tetromino.SHAPETABLES[shape][rotation % len(tetromino.SHAPES[shape])]
+     ['cells'] for rotation in range(MAXROTATIONS)]
+    for shape in SHAPENAMES])
+SPAWNX, SPAWNY = tetromino.SHAPETABLES[SHAPENAMES[0]][0]['spawn']
+
+# The environment is a dictionary of NumPy arrays, with one entry per board
+# along the first axis:
+#     'boards' - numBoards x BOARDHEIGHT x BOARDWIDTH bytes, holding the color
+#                index + 1 of every box, or 0 for a blank space
+#     'shape', 'rotation', 'x', 'y', 'color' - The falling piece; shapes are
+#                indexes into SHAPENAMES
+#     'nextShape', 'nextRotation', 'nextColor' - The next piece
+#     'score', 'level', 'fallFreq' - As in tetromino.py
+#     'time', 'lastFallTime' - Seconds of game time, as in tetromino.stepGame()
+#     'random' - The numpy.random.Generator the pieces come from
+
+
+def newVecEnv(numBoards=NUMBOARDS, seed=None):
+    # Return an environment with numBoards new games
+    env = {'random': numpy.random.default_rng(seed),
+           'boards': numpy.zeros((numBoards, BOARDHEIGHT, BOARDWIDTH),
+                                 dtype=numpy.uint8)}
+    for key in ('shape', 'rotation', 'x', 'y', 'color', 'nextShape',
+                'nextRotation', 'nextColor', 'score', 'level'):
+        env[key] = numpy.zeros(numBoards, dtype=numpy.int64)
+    for key in ('fallFreq', 'time', 'lastFallTime'):
+        env[key] = numpy.zeros(numBoards)
+    resetBoards(env, numpy.arange(numBoards))
+    return env
+
+
+def getNewPieces(env, count):
+    # Return the shapes, rotations and colors of count random pieces
+    rng = env['random']
+    shapes = rng.integers(0, len(SHAPENAMES), count)
+    rotations = (rng.random(count) * NUMROTATIONS[shapes]).astype(numpy.int64)
+    colors = rng.integers(0, len(tetromino.COLORS), count)
+    return shapes, rotations, colors
+
+
+def resetBoards(env, indexes):
+    # Start new games on the boards with the given indexes
+    env['boards'][indexes] = 0
+    count = len(indexes)
+    (env['shape'][indexes], env['rotation'][indexes],
+     env['color'][indexes]) = getNewPieces(env, count)
+    (env['nextShape'][indexes], env['nextRotation'][indexes],
+     env['nextColor'][indexes]) = getNewPieces(env, count)
+    env['x'][indexes] = SPAWNX
+    env['y'][indexes] = SPAWNY
+    env['score'][indexes] = 0
+    env['level'][indexes], env['fallFreq'][indexes] = \
+        tetromino.calculateLevelAndFallFreq(env['score'][indexes])
+    env['time'][indexes] = 0.0
+    env['lastFallTime'][indexes] = 0.0
+
+
+def isValidPositions(env, indexes, shapes, rotations, xs, ys):
+    # Return a boolean array telling if each piece fits on its board; the
+    # batched version of tetromino.isValidPosition()
+    cells = CELLOFFSETS[shapes, rotations]
+    boxx = cells[:, :, 0] + xs[:, None]
+    boxy = cells[:, :, 1] + ys[:, None]
+    aboveBoard = boxy < 0  # Boxes above the board aren't checked
+    onBoard = (boxx >= 0) & (boxx < BOARDWIDTH) & (boxy < BOARDHEIGHT)
+    blank = env['boards'][indexes[:, None],
+                          boxy.clip(0, BOARDHEIGHT - 1),
+                          boxx.clip(0, BOARDWIDTH - 1)] == 0
+    return (aboveBoard | (onBoard & blank)).all(axis=1)
+
+
+def getDropDistances(env, indexes):
+    # Return how many rows each falling piece can fall before it lands
+    distances = numpy.zeros(len(indexes), dtype=numpy.int64)
+    falling = numpy.arange(len(indexes))  # Pieces that haven't landed yet
+    while len(falling):
+        i = indexes[falling]
+        fits = isValidPositions(env, i, env['shape'][i], env['rotation'][i],
+                                env['x'][i], env['y'][i] +
+                                distances[falling] + 1)
+        falling = falling[fits]
+        distances[falling] += 1
+    return distances
+
+
+def applyActions(env, actions):
+    # Move or rotate each falling piece as its action says, if it fits
+    indexes = numpy.flatnonzero((actions != NOOP) & (actions != HARDDROP))
+    acts = actions[indexes]
+    shapes = env['shape'][indexes]
+    xs = env['x'][indexes] + (acts == MOVERIGHT) - (acts == MOVELEFT)
+    ys = env['y'][indexes] + (acts == MOVEDOWN)
+    rotations = (env['rotation'][indexes] + (acts == ROTATE) -
+                 (acts == ROTATEBACK)) % NUMROTATIONS[shapes]
+    fits = isValidPositions(env, indexes, shapes, rotations, xs, ys)
+    indexes = indexes[fits]
+    env['x'][indexes] = xs[fits]
+    env['y'][indexes] = ys[fits]
+    env['rotation'][indexes] = rotations[fits]
+
+    indexes = numpy.flatnonzero(actions == HARDDROP)
+    env['y'][indexes] += getDropDistances(env, indexes)
+
+
+def lockPieces(env, indexes):
+    # Add the falling pieces of the given boards to them, remove complete
+    # lines and return the number of lines removed from each board; the
+    # batched version of tetromino.addToBoard() and removeCompleteLines()
+    boards = env['boards']
+    cells = CELLOFFSETS[env['shape'][indexes], env['rotation'][indexes]]
+    boxx = cells[:, :, 0] + env['x'][indexes, None]
+    boxy = cells[:, :, 1] + env['y'][indexes, None]
+    boardIndexes = numpy.broadcast_to(indexes[:, None], boxx.shape)
+    onBoard = boxy >= 0  # Boxes above the board can't be stored
+    boards[boardIndexes[onBoard], boxy[onBoard], boxx[onBoard]] = (
+        numpy.broadcast_to(env['color'][indexes, None] + 1,
+                           boxx.shape)[onBoard])
+
+    # Sort the complete lines of each board to the top (keeping the other
+    # rows in order) and blank them
+    locked = boards[indexes]
+    complete = (locked != 0).all(axis=2)
+    numLinesRemoved = complete.sum(axis=1)
+    cleared = numpy.flatnonzero(numLinesRemoved)
+    if len(cleared):
+        order = numpy.argsort(~complete[cleared], axis=1, kind='stable')
+        rows = numpy.take_along_axis(locked[cleared], order[:, :, None],
+                                     axis=1)
+        rows[numpy.arange(BOARDHEIGHT) <
+             numLinesRemoved[cleared, None]] = 0
+        boards[indexes[cleared]] = rows
+    return numLinesRemoved
+
+
+def stepVecEnv(env, actions):
+    # Advance every board by one tick: apply each board's action, then let
+    # the pieces fall as in tetromino.stepGame(). Returns the number of
+    # lines each board removed and a boolean array of the games that ended
+    # (and were reset) this step
+    numBoards = len(env['boards'])
+    linesRemoved = numpy.zeros(numBoards, dtype=numpy.int64)
+    gameOver = numpy.zeros(numBoards, dtype=bool)
+    applyActions(env, numpy.asarray(actions))
+
+    # Let the pieces fall if it is time to fall
+    timeSinceFall = env['time'] - env['lastFallTime']
+    due = numpy.flatnonzero(timeSinceFall > env['fallFreq'])
+    distances = getDropDistances(env, due)
+    fallFreq = env['fallFreq'][due]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        numRows = numpy.where(fallFreq > 0,
+                              numpy.floor(timeSinceFall[due] / fallFreq),
+                              BOARDHEIGHT)
+    numRows = numpy.minimum(numRows, distances).astype(numpy.int64)
+    env['y'][due] += numRows
+    carry = (fallFreq > 0) & (numRows < distances)
+    env['lastFallTime'][due] = numpy.where(
+        carry, env['lastFallTime'][due] + numRows * fallFreq,
+        env['time'][due])
+    env['time'] += tetromino.TICKLENGTH
+
+    landed = due[distances == 0]
+    if len(landed):
+        linesRemoved[landed] = lockPieces(env, landed)
+        env['score'][landed] += linesRemoved[landed]
+        env['level'][landed], env['fallFreq'][landed] = \
+            tetromino.calculateLevelAndFallFreq(env['score'][landed])
+
+        # Start the next pieces at the top
+        env['shape'][landed] = env['nextShape'][landed]
+        env['rotation'][landed] = env['nextRotation'][landed]
+        env['color'][landed] = env['nextColor'][landed]
+        env['x'][landed] = SPAWNX
+        env['y'][landed] = SPAWNY
+        (env['nextShape'][landed], env['nextRotation'][landed],
+         env['nextColor'][landed]) = getNewPieces(env, len(landed))
+        fits = isValidPositions(env, landed, env['shape'][landed],
+                                env['rotation'][landed], env['x'][landed],
+                                env['y'][landed])
+        ended = landed[~fits]
+        gameOver[ended] = True
+        resetBoards(env, ended)
+    return linesRemoved, gameOver
+
+
+def benchmark(numBoards, numSteps):
+    env = newVecEnv(numBoards, seed=0)
+    rng = numpy.random.default_rng(1)
+    actions = rng.integers(0, NUMACTIONS, (numSteps, numBoards))
+    lines = 0
+    games = 0
+    startTime = time.perf_counter()
+    for step in range(numSteps):
+        linesRemoved, gameOver = stepVecEnv(env, actions[step])
+        lines += int(linesRemoved.sum())
+        games += int(gameOver.sum())
+    elapsed = time.perf_counter() - startTime
+    print(f'{numBoards} boards x {numSteps} steps in {elapsed:.2f}s: '
+          f'{numBoards * numSteps / elapsed:.0f} board-steps/s '
+          f'({games} games finished, {lines} lines)')
+
+
+def main():
+    numBoards = int(sys.argv[1]) if len(sys.argv) > 1 else NUMBOARDS
+    numSteps = int(sys.argv[2]) if len(sys.argv) > 2 else NUMSTEPS
+    benchmark(numBoards, numSteps)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import collections
 import random
 import sys
 import time
@@ -5,6 +6,11 @@ import math
 import pygame
 from pygame.locals import *  # noqa: F403
 
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Needed for the squirrel store, see main()
+
 FPS = 30
 WINWIDTH = 640
 WINHEIGHT = 480
@@ -25,20 +31,37 @@ INVULNTIME = 2        # How long the player is invulnerable after hit (sec)
 GAMEOVERTIME = 4      # How long the "game over" text stays on screen (sec)
 MAXHEALTH = 3         # How much health the player starts with
 
-NUMGRASS = 80         # Number of grass objects in the active area
 NUMSQUIRRELS = 30     # Number of squirrels in the active area
 SQUIRRELMINSPEED = 3  # Slowest squirrel speed
 SQUIRRELMAXSPEED = 7  # Fastest squirrel speed
 DIRCHANGEFREQ = 2     # % chance of direction change per frame
+CHUNKSIZE = 256       # Size of the square chunks of grass, in world pixels
+MAXGRASSPERCHUNK = 3  # Each chunk has 1 to this many grass images
+MAXCHUNKS = 64        # How many chunk images are kept in memory
+SCALECACHEBYTES = 32 * 1024 * 1024  # Memory for scaled squirrel images
 LEFT = 'left'
 RIGHT = 'right'
 
+# Every field of the squirrel store that is a NumPy array
+SQUIRRELFIELDS = ('x', 'y', 'movex', 'movey', 'width', 'height', 'bounce',
+                  'bouncerate', 'bounceheight')
+MAXBOUNCERATE = 18
+
+if numpy is not None:
+    # BOUNCESINES[bounceRate, currentBounce] is the sine getBounceAmount()
+    # takes for that point in a bounce, so a bounce offset is one
+    # multiplication
+    BOUNCESINES = numpy.array([
+        [math.sin((math.pi / float(bounceRate)) * currentBounce)
+         if bounceRate else 0.0
+         for currentBounce in range(MAXBOUNCERATE + 1)]
+        for bounceRate in range(MAXBOUNCERATE + 1)])
+
 '''
-This progam has three data structures to represent the player, enemy squirrels,
-and grass background objects. The data structures are dictionaries with the
-following keys:
+This progam has two data structures to represent the player and enemy
+squirrels. The data structures are dictionaries with the following keys:
 
-Keys used by all three data structures:
+Keys used by both data structures:
     'x' - The left edge coordinate of the object in the game world (not a pixel
           coordinate on the screen)
     'y' - The top edge coordinate of the object in the game world (not a pixel
@@ -67,15 +90,39 @@ Keys used by all three data structures:
     'bouncerate' - How quickly the squirrel bounces; lower is quicker
     'bounceheight' - How high (in pixels) the squirrel bounces
 
-Grass data structure keys:
-    'grassImage' - An integer that refers to the index of the pygame.Surface
-                   object in GRASSIMAGES used for this grass object
+The grass background is split into CHUNKSIZE square chunks. The grass in a
+chunk only depends on the world's seed and the chunk's (column, row), so an
+area looks the same every time the player comes back to it. The world is a
+dictionary with the keys:
+    'seed' - The seed every chunk's grass is made from
+    'chunks' - An OrderedDict of the images of the chunks drawn recently by
+               their (column, row), least recently drawn first. Only
+               MAXCHUNKS are kept; the others are made again when needed
+    'made' - How many chunk images have been made
+    'evictions' - How many chunk images have been forgotten
+
+The enemy squirrels are kept in a squirrel store instead of one dictionary
+each, so that all of them are moved, bounced and culled with a few NumPy
+operations per frame. The arrays have room for more squirrels than there
+are, so squirrels are added and removed without making new arrays. It is a
+dictionary with the keys:
+    'x', 'y', 'movex', 'movey', 'width', 'height', 'bounce', 'bouncerate',
+    'bounceheight' - NumPy arrays with the squirrel data structure key of
+              the same name for every squirrel in their first 'count'
+              entries, in the order they are drawn in
+    'count' - How many squirrels there are
+    'surfaces' - A list of every squirrel's 'surface', in the same order
+    'random' - The numpy.random.Generator the squirrels' sizes, positions
+               and movements come from
 '''
 
 
 def main():
     global FPSCLOCK, DISPLAYSURF, BASICFONT, L_SQUIR_IMG, R_SQUIR_IMG, \
-           GRASSIMAGES
+           GRASSIMAGES, SCALECACHE
+
+    if numpy is None:
+        raise ImportError('Squirrel Eat Squirrel needs NumPy')
 
     pygame.init()
     FPSCLOCK = pygame.time.Clock()
@@ -84,13 +131,17 @@ def main():
     pygame.display.set_caption('Squirrel Eat Squirrel')
     BASICFONT = pygame.font.Font('freesansbold.ttf', 32)
 
-    # Load the image files
-    L_SQUIR_IMG = pygame.image.load('squirrel.png')
+    # Load the image files, converted to the display's pixel format so
+    # they don't have to be converted every time they are drawn
+    L_SQUIR_IMG = pygame.image.load('squirrel.png').convert_alpha()
     R_SQUIR_IMG = pygame.transform.flip(L_SQUIR_IMG, True, False)
-    GRASSIMAGES = [pygame.image.load(f'grass{i}.png') for i in range(1, 5)]
+    GRASSIMAGES = [pygame.image.load(f'grass{i}.png').convert_alpha()
+                   for i in range(1, 5)]
+    SCALECACHE = newScaleCache()
 
     while True:
         runGame()
+        printScaleCacheReport(SCALECACHE)
 
 
 def runGame():
@@ -119,12 +170,11 @@ def runGame():
     camerax = 0
     cameray = 0
 
-    grassObjs = []     # Stores all the grass objects in the game
-    squirrelObjs = []  # Stores all the non-player squirrel objects
+    world = newWorld()               # Stores the grass background
+    squirrels = newSquirrelStore()   # Stores all the non-player squirrels
     # Stores the player object:
     playerObj = {
-        'surface': pygame.transform.scale(
-            L_SQUIR_IMG, (STARTSIZE, STARTSIZE)),
+        'surface': getScaledSquirrel(SCALECACHE, LEFT, STARTSIZE, STARTSIZE),
         'facing': LEFT,
         'size': STARTSIZE,
         'x': HALF_WINWIDTH,
@@ -134,12 +184,6 @@ def runGame():
 
     moveLeft, moveRight, moveUp, moveDown = [False] * 4
 
-    # Start off with some random grass images on the screen
-    for i in range(10):
-        grassObjs.append(makeNewGrass(camerax, cameray))
-        grassObjs[i]['x'] = random.randint(0, WINWIDTH)
-        grassObjs[i]['y'] = random.randint(0, WINHEIGHT)
-
     while True:  # Main game loop
         # Check if we should turn off invulnerability
         if invulnerableMode and (
@@ -147,35 +191,16 @@ def runGame():
             invulnerableMode = False
 
         # Move all the squirrels
-        for sObj in squirrelObjs:
-            # Move the squirrel and adjust for their bounce
-            sObj['x'] += sObj['movex']
-            sObj['y'] += sObj['movey']
-            sObj['bounce'] += 1
-            if sObj['bounce'] > sObj['bouncerate']:
-                sObj['bounce'] = 0  # Reset bounce amount
-
-            # Random chance they change direction
-            if random.randint(0, 99) < DIRCHANGEFREQ:
-                sObj['movex'] = getRandomVelocity()
-                sObj['movey'] = getRandomVelocity()
-                sObj['surface'] = pygame.transform.scale(
-                        R_SQUIR_IMG if sObj['movex'] > 0 else L_SQUIR_IMG,
-                        (sObj['width'], sObj['height']))
-
-        # Go through all the objects and see if any need to be deleted
-        for i in range(len(grassObjs) - 1, -1, -1):
-            if isOutsideActiveArea(camerax, cameray, grassObjs[i]):
-                del grassObjs[i]
-        for i in range(len(squirrelObjs) - 1, -1, -1):
-            if isOutsideActiveArea(camerax, cameray, squirrelObjs[i]):
-                del squirrelObjs[i]
-
-        # Add more grass & squirrels if we don't have enough
-        while len(grassObjs) < NUMGRASS:
-            grassObjs.append(makeNewGrass(camerax, cameray))
-        while len(squirrelObjs) < NUMSQUIRRELS:
-            squirrelObjs.append(makeNewSquirrel(camerax, cameray))
+        moveSquirrels(squirrels)
+
+        # Go through all the squirrels and see if any need to be deleted
+        removeSquirrels(squirrels, numpy.flatnonzero(
+            isOutsideActiveArea(camerax, cameray, squirrels)))
+
+        # Add more squirrels if we don't have enough
+        if squirrels['count'] < NUMSQUIRRELS:
+            spawnSquirrels(squirrels, NUMSQUIRRELS - squirrels['count'],
+                           camerax, cameray)
 
         # Adjust camerax and cameray if beyond the "camera slack"
         playerCenterx = playerObj['x'] + playerObj['size'] // 2
@@ -189,29 +214,22 @@ def runGame():
         elif playerCentery - (cameray + HALF_WINHEIGHT) > CAMERASLACK:
             cameray = playerCentery - CAMERASLACK - HALF_WINHEIGHT
 
-        # Draw the green background
-        DISPLAYSURF.fill(GRASSCOLOR)
-
-        # Draw all the grass objects on the screen
-        for gObj in grassObjs:
-            gRect = pygame.Rect((
-                gObj['x'] - camerax,
-                gObj['y'] - cameray,
-                gObj['width'],
-                gObj['height']))
-            DISPLAYSURF.blit(GRASSIMAGES[gObj['grassImage']], gRect)
-
-        # Draw the other squirrels
-        for sObj in squirrelObjs:
-            sObj['rect'] = pygame.Rect((
-                sObj['x'] - camerax,
-                sObj['y'] - cameray - getBounceAmount(
-                    sObj['bounce'], sObj['bouncerate'], sObj['bounceheight']),
-                sObj['width'],
-                sObj['height']))
-            DISPLAYSURF.blit(sObj['surface'], sObj['rect'])
-
-        # Draw the player squirrel
+        # Everything up to the health meter is drawn with one blits() call,
+        # in the order it is added to blitSequence. First the green
+        # background and its grass
+        blitSequence = getWorldBlits(world, camerax, cameray)
+
+        # Then the other squirrels that are on the screen
+        onScreen = getSquirrelsInArea(squirrels, camerax, cameray,
+                                      camerax + WINWIDTH, cameray + WINHEIGHT)
+        screenx = squirrels['x'][onScreen] - camerax
+        screeny = (squirrels['y'][onScreen] - cameray -
+                   getBounceAmounts(squirrels, onScreen))
+        blitSequence.extend(zip(
+            map(squirrels['surfaces'].__getitem__, onScreen.tolist()),
+            zip(screenx.tolist(), screeny.tolist())))
+
+        # Then the player squirrel
         flashIsOn = round(time.time(), 1) * 10 % 2 == 1
         if not gameOverMode and not(invulnerableMode and flashIsOn):
             playerObj['rect'] = pygame.Rect((
@@ -220,7 +238,8 @@ def runGame():
                     playerObj['bounce'], BOUNCERATE, BOUNCEHEIGHT),
                 playerObj['size'],
                 playerObj['size']))
-            DISPLAYSURF.blit(playerObj['surface'], playerObj['rect'])
+            blitSequence.append((playerObj['surface'], playerObj['rect']))
+        DISPLAYSURF.blits(blitSequence, doreturn=False)
 
         # Draw the health meter
         drawHealthMeter(playerObj['health'])
@@ -241,18 +260,18 @@ def runGame():
                     moveLeft = True
                     if playerObj['facing'] == RIGHT:  # noqa: F405
                         # Change player image
-                        playerObj['surface'] = pygame.transform.scale(
-                                L_SQUIR_IMG,
-                                tuple([playerObj['size']] * 2))
+                        playerObj['surface'] = getScaledSquirrel(
+                                SCALECACHE, LEFT,
+                                playerObj['size'], playerObj['size'])
                         playerObj['facing'] = LEFT    # noqa: F405
                 elif event.key in (K_RIGHT, K_d):     # noqa: F405
                     moveLeft = False
                     moveRight = True
                     if playerObj['facing'] == LEFT:   # noqa: F405
                         # Change player image
-                        playerObj['surface'] = pygame.transform.scale(
-                                R_SQUIR_IMG,
-                                tuple([playerObj['size']] * 2))
+                        playerObj['surface'] = getScaledSquirrel(
+                                SCALECACHE, RIGHT,
+                                playerObj['size'], playerObj['size'])
                         playerObj['facing'] = RIGHT   # noqa: F405
                 elif winMode and event.key == K_r:    # noqa: F405
                     return
@@ -288,38 +307,35 @@ def runGame():
             if playerObj['bounce'] > BOUNCERATE:
                 playerObj['bounce'] = 0  # Reset bounce amount
 
-            # CHeck if the player has collided with any squirrels
-            for i in range(len(squirrelObjs) - 1, -1, -1):
-                sqObj = squirrelObjs[i]
-                if 'rect' in sqObj and playerObj['rect'].colliderect(
-                        sqObj['rect']):
-                    # A player/squirrel collision has occurred
-
-                    if sqObj['width'] * sqObj['height'] <= (
-                            playerObj['size']**2):
-                        # Player is larger and eats the squirrel
-                        playerObj['size'] += int((
-                                sqObj['width'] * sqObj['height'])**0.2) + 1
-                        del squirrelObjs[i]
-
-                        if playerObj['facing'] == LEFT:
-                            pygame.transform.scale(
-                                    L_SQUIR_IMG,
-                                    tuple([playerObj['size']] * 2))
-                        if playerObj['facing'] == RIGHT:
-                            playerObj['surface'] = pygame.transform.scale(
-                                    R_SQUIR_IMG,
-                                    tuple([playerObj['size']] * 2))
-                        if playerObj['size'] > WINSIZE:
-                            winMode = True  # Turn on "win mode"
-                    elif not invulnerableMode:
-                        # Player is smaller and takes damage
-                        invulnerableMode = True
-                        invulnerableStartTime = time.time()
-                        playerObj['health'] -= 1
-                        if playerObj['health'] == 0:
-                            gameOverMode = True  # Turn on "game over mode"
-                            gameOverStartTime = time.time()
+            # CHeck if the player has collided with any squirrels (where it
+            # was last drawn), in game world coordinates
+            playerRect = playerObj['rect'].move(camerax, cameray)
+            eaten = []
+            for i in getSquirrelsInArea(
+                    squirrels, playerRect.left, playerRect.top,
+                    playerRect.right, playerRect.bottom)[::-1].tolist():
+                # A player/squirrel collision has occurred
+                sqArea = int(squirrels['width'][i] * squirrels['height'][i])
+                if sqArea <= playerObj['size']**2:
+                    # Player is larger and eats the squirrel
+                    playerObj['size'] += int(sqArea**0.2) + 1
+                    eaten.append(i)
+                    if playerObj['size'] > WINSIZE:
+                        winMode = True  # Turn on "win mode"
+                elif not invulnerableMode:
+                    # Player is smaller and takes damage
+                    invulnerableMode = True
+                    invulnerableStartTime = time.time()
+                    playerObj['health'] -= 1
+                    if playerObj['health'] == 0:
+                        gameOverMode = True  # Turn on "game over mode"
+                        gameOverStartTime = time.time()
+            if eaten:
+                removeSquirrels(squirrels, numpy.array(eaten[::-1]))
+                # Scale the player image once for all it ate this frame
+                playerObj['surface'] = getScaledSquirrel(
+                        SCALECACHE, playerObj['facing'],
+                        playerObj['size'], playerObj['size'])
         else:
             # Game is over; show "game over" text
             DISPLAYSURF.blit(gameOverSurf, gameOverRect)
@@ -347,6 +363,7 @@ def drawHealthMeter(currentHealth):
 
 
 def terminate():
+    printScaleCacheReport(SCALECACHE)
     pygame.quit()
     sys.exit()
 
@@ -360,69 +377,265 @@ def getBounceAmount(currentBounce, bounceRate, bounceHeight):
         math.pi / float(bounceRate)) * currentBounce) * bounceHeight)
 
 
-def getRandomVelocity():
-    speed = random.randint(SQUIRRELMINSPEED, SQUIRRELMAXSPEED)
-    if random.randint(0, 1) == 0:
-        return speed
-    else:
-        return -speed
-
-
-def getRandomOffCameraPos(camerax, cameray, objWidth, objHeight):
-    # Create a Rect of the camera view
-    cameraRect = pygame.Rect(camerax, cameray, WINWIDTH, WINHEIGHT)
-    while True:
-        x = random.randint(camerax - WINWIDTH, camerax + (2 * WINWIDTH))
-        y = random.randint(cameray - WINHEIGHT, cameray + (2 * WINHEIGHT))
-        # Create a Rect object with the random coordinates and use
-        # colliderect() to make sure the right edge isn't in the camera view
-        objRect = pygame.Rect(x, y, objWidth, objHeight)
-        if not objRect.colliderect(cameraRect):
-            return x, y
-
-
-def makeNewSquirrel(camerax, cameray):
-    sq = {}
-    generalSize = random.randint(5, 25)
-    multiplier = random.randint(1, 3)
-    sq['width'] = (generalSize + random.randint(0, 10)) * multiplier
-    sq['height'] = (generalSize + random.randint(0, 10)) * multiplier
-    sq['x'], sq['y'] = getRandomOffCameraPos(
-            camerax, cameray, sq['width'], sq['height'])
-    sq['movex'] = getRandomVelocity()
-    sq['movey'] = getRandomVelocity()
-    if sq['movex'] < 0:  # Squirrel is facing left
-        sq['surface'] = pygame.transform.scale(
-                L_SQUIR_IMG, (sq['width'], sq['height']))
-    else:  # Squirrel is facing right
-        sq['surface'] = pygame.transform.scale(
-                R_SQUIR_IMG, (sq['width'], sq['height']))
-    sq['bounce'] = 0
-    sq['bouncerate'] = random.randint(10, 18)
-    sq['bounceheight'] = random.randint(10, 50)
-    return sq
-
-
-def makeNewGrass(camerax, cameray):
-    gr = {}
-    gr['grassImage'] = random.randint(0, len(GRASSIMAGES) - 1)
-    gr['width'] = GRASSIMAGES[0].get_width()
-    gr['height'] = GRASSIMAGES[0].get_height()
-    gr['x'], gr['y'] = getRandomOffCameraPos(
-            camerax, cameray, gr['width'], gr['height'])
-    gr['rect'] = pygame.Rect((gr['x'], gr['y'], gr['width'], gr['height']))
-    return gr
-
-
-def isOutsideActiveArea(camerax, cameray, obj):
-    # Return False if camerax and cameray are more than a halp-window length
-    # beyond the edge of the window
-    boundsLeftEdge = camerax - WINWIDTH
-    boundsTopEdge = cameray - WINHEIGHT
-    boundsRect = pygame.Rect(
-            boundsLeftEdge, boundsTopEdge, WINWIDTH * 3, WINHEIGHT * 3)
-    objRect = pygame.Rect(obj['x'], obj['y'], obj['width'], obj['height'])
-    return not boundsRect.colliderect(objRect)
+def newScaleCache(maxBytes=SCALECACHEBYTES):
+    # Return a cache of scaled squirrel images for getScaledSquirrel(),
+    # which forgets the least recently used ones to stay under maxBytes
+    return {
+        'surfaces': collections.OrderedDict(),  # By (facing, width,
+                                                # height), least recently
+                                                # used first
+        'bytes': 0,
+        'maxBytes': maxBytes,
+        'hits': 0,
+        'misses': 0,
+        'evictions': 0}
+
+
+def getScaledSquirrel(cache, facing, width, height):
+    # Return the squirrel image facing LEFT or RIGHT scaled to width and
+    # height, but only scale it the first time a size is asked for. The
+    # surfaces are shared, so they must not be changed
+    key = (facing, width, height)
+    surfaces = cache['surfaces']
+    scaledSurf = surfaces.get(key)
+    if scaledSurf is not None:
+        surfaces.move_to_end(key)
+        cache['hits'] += 1
+        return scaledSurf
+
+    cache['misses'] += 1
+    scaledSurf = pygame.transform.scale(
+            L_SQUIR_IMG if facing == LEFT else R_SQUIR_IMG, (width, height))
+    surfBytes = getSurfBytes(scaledSurf)
+    if surfBytes <= cache['maxBytes']:
+        surfaces[key] = scaledSurf
+        cache['bytes'] += surfBytes
+        while cache['bytes'] > cache['maxBytes']:
+            oldKey, oldSurf = surfaces.popitem(last=False)
+            cache['bytes'] -= getSurfBytes(oldSurf)
+            cache['evictions'] += 1
+    return scaledSurf
+
+
+def printScaleCacheReport(cache):
+    lookups = cache['hits'] + cache['misses']
+    if lookups:
+        print(f"Scale cache: {cache['hits'] / lookups:.1%} hits, "
+              f"{cache['misses']} misses, {cache['evictions']} evictions, "
+              f"{cache['bytes'] / (1024 * 1024):.1f}MB")
+
+
+def getSurfBytes(surf):
+    return surf.get_pitch() * surf.get_height()
+
+
+def newWorld(seed=None):
+    if seed is None:
+        seed = random.randrange(2**32)
+    return {'seed': seed, 'chunks': collections.OrderedDict(),
+            'made': 0, 'evictions': 0}
+
+
+def makeChunkSurf(world, column, row):
+    # Return the image of a chunk: the green background and its grass,
+    # placed at random by a random.Random() seeded from the chunk alone
+    chunkRandom = random.Random(f'{world["seed"]},{column},{row}')
+    chunkSurf = pygame.Surface((CHUNKSIZE, CHUNKSIZE))
+    chunkSurf.fill(GRASSCOLOR)
+    for i in range(chunkRandom.randint(1, MAXGRASSPERCHUNK)):
+        grassImage = GRASSIMAGES[chunkRandom.randint(0, len(GRASSIMAGES) - 1)]
+        # Keep the whole image in the chunk, so none is cut off at the edge
+        chunkSurf.blit(grassImage, (
+            chunkRandom.randint(0, CHUNKSIZE - grassImage.get_width()),
+            chunkRandom.randint(0, CHUNKSIZE - grassImage.get_height())))
+    return chunkSurf
+
+
+def getChunkSurf(world, column, row):
+    # Return the image of a chunk, making it if it isn't kept in memory
+    chunks = world['chunks']
+    chunkSurf = chunks.get((column, row))
+    if chunkSurf is not None:
+        chunks.move_to_end((column, row))
+        return chunkSurf
+
+    chunkSurf = makeChunkSurf(world, column, row)
+    world['made'] += 1
+    chunks[(column, row)] = chunkSurf
+    while len(chunks) > MAXCHUNKS:
+        chunks.popitem(last=False)
+        world['evictions'] += 1
+    return chunkSurf
+
+
+def getWorldBlits(world, camerax, cameray):
+    # Return a list of (surface, position) pairs for blits() that draw the
+    # chunks that are on the screen
+    return [(getChunkSurf(world, column, row),
+             (column * CHUNKSIZE - camerax, row * CHUNKSIZE - cameray))
+            for column in range(camerax // CHUNKSIZE,
+                                (camerax + WINWIDTH - 1) // CHUNKSIZE + 1)
+            for row in range(cameray // CHUNKSIZE,
+                             (cameray + WINHEIGHT - 1) // CHUNKSIZE + 1)]
+
+
+def newSquirrelStore(capacity=NUMSQUIRRELS):
+    store = {field: numpy.zeros(capacity, dtype=numpy.int64)
+             for field in SQUIRRELFIELDS}
+    store['count'] = 0
+    store['surfaces'] = []
+    store['random'] = numpy.random.default_rng()
+    return store
+
+
+def growSquirrelStore(store, capacity):
+    # Move the squirrels to arrays with room for capacity squirrels
+    count = store['count']
+    for field in SQUIRRELFIELDS:
+        grown = numpy.zeros(capacity, dtype=numpy.int64)
+        grown[:count] = store[field][:count]
+        store[field] = grown
+
+
+def spawnSquirrels(store, numSquirrels, camerax, cameray):
+    # Add numSquirrels new random squirrels outside of the camera view
+    start = store['count']
+    end = start + numSquirrels
+    if end > len(store['x']):
+        growSquirrelStore(store, max(end, 2 * len(store['x'])))
+    rng = store['random']
+    generalSize = rng.integers(5, 26, numSquirrels)
+    multiplier = rng.integers(1, 4, numSquirrels)
+    width = (generalSize + rng.integers(0, 11, numSquirrels)) * multiplier
+    height = (generalSize + rng.integers(0, 11, numSquirrels)) * multiplier
+    store['width'][start:end] = width
+    store['height'][start:end] = height
+    store['x'][start:end], store['y'][start:end] = getRandomOffCameraPos(
+            rng, camerax, cameray, width, height)
+    store['movex'][start:end] = getRandomVelocity(rng, numSquirrels)
+    store['movey'][start:end] = getRandomVelocity(rng, numSquirrels)
+    store['bounce'][start:end] = 0
+    store['bouncerate'][start:end] = rng.integers(10, 19, numSquirrels)
+    store['bounceheight'][start:end] = rng.integers(10, 51, numSquirrels)
+    store['surfaces'].extend(
+        getScaledSquirrel(SCALECACHE, LEFT if movex < 0 else RIGHT,
+                          sqWidth, sqHeight)
+        for movex, sqWidth, sqHeight in zip(
+            store['movex'][start:end].tolist(), width.tolist(),
+            height.tolist()))
+    store['count'] = end
+
+
+def removeSquirrels(store, indexes):
+    # Remove the squirrels at the sorted indexes by moving the last
+    # squirrels into their places, so the other squirrels don't have to
+    # be moved down (this changes the order the moved squirrels are drawn
+    # in)
+    count = store['count'] - len(indexes)
+    holes = indexes[indexes < count]
+    lastKept = numpy.ones(store['count'] - count, dtype=bool)
+    lastKept[indexes[indexes >= count] - count] = False
+    moved = count + numpy.flatnonzero(lastKept)
+    for field in SQUIRRELFIELDS:
+        store[field][holes] = store[field][moved]
+    surfaces = store['surfaces']
+    for hole, i in zip(holes.tolist(), moved.tolist()):
+        surfaces[hole] = surfaces[i]
+    del surfaces[count:]
+    store['count'] = count
+
+
+def getRandomVelocity(rng, numSquirrels):
+    speed = rng.integers(SQUIRRELMINSPEED, SQUIRRELMAXSPEED + 1, numSquirrels)
+    return numpy.where(rng.integers(0, 2, numSquirrels) == 0, speed, -speed)
+
+
+def getRandomOffCameraPos(rng, camerax, cameray, objWidth, objHeight):
+    # Return arrays of random x and y coordinates in the active area where
+    # objects of the given widths and heights aren't in the camera view.
+    # The positions that are allowed make a ring around the camera view:
+    # full rows above and below it, and the rows beside it without the
+    # columns where the object would overlap the view. Each position is
+    # picked directly from the ring's rows, all equally likely
+    # Columns from camerax - WINWIDTH to camerax + 2 * WINWIDTH
+    numColumns = 3 * WINWIDTH + 1
+    numRowsAbove = WINHEIGHT - objHeight + 1
+    numRowsBeside = WINHEIGHT + objHeight - 1
+    numColumnsLeft = WINWIDTH - objWidth + 1
+    numColumnsBeside = numColumns - (WINWIDTH + objWidth - 1)
+    aboveEnd = numRowsAbove * numColumns
+    besideEnd = aboveEnd + numRowsBeside * numColumnsBeside
+    numPositions = besideEnd + (WINHEIGHT + 1) * numColumns
+    position = rng.integers(0, numPositions)
+
+    # Find the row and the column in the row of each position
+    beside = (position >= aboveEnd) & (position < besideEnd)
+    below = position >= besideEnd
+    rowStart = numpy.where(below, besideEnd, numpy.where(beside, aboveEnd, 0))
+    rowLength = numpy.where(beside, numColumnsBeside, numColumns)
+    row = numpy.where(below, numRowsAbove + numRowsBeside,
+                      numpy.where(beside, numRowsAbove, 0)) + (
+                          (position - rowStart) // rowLength)
+    column = (position - rowStart) % rowLength
+    # Skip the columns that overlap the camera view in the rows beside it
+    column += beside * (column >= numColumnsLeft) * (
+        WINWIDTH + objWidth - 1)
+    return camerax - WINWIDTH + column, cameray - WINHEIGHT + row
+
+
+def moveSquirrels(store):
+    # Move every squirrel and adjust for their bounce
+    count = store['count']
+    store['x'][:count] += store['movex'][:count]
+    store['y'][:count] += store['movey'][:count]
+    bounce = store['bounce'][:count]
+    bounce += 1
+    bounce[bounce > store['bouncerate'][:count]] = 0  # Reset bounce amount
+
+    # Random chance they change direction
+    rng = store['random']
+    changed = numpy.flatnonzero(rng.integers(0, 100, count) < DIRCHANGEFREQ)
+    store['movex'][changed] = getRandomVelocity(rng, len(changed))
+    store['movey'][changed] = getRandomVelocity(rng, len(changed))
+    surfaces = store['surfaces']
+    for i, movex, width, height in zip(
+            changed.tolist(), store['movex'][changed].tolist(),
+            store['width'][changed].tolist(),
+            store['height'][changed].tolist()):
+        surfaces[i] = getScaledSquirrel(
+                SCALECACHE, RIGHT if movex > 0 else LEFT, width, height)
+
+
+def getBounceAmounts(store, indexes):
+    # The getBounceAmount() of the squirrels at the indexes
+    return (BOUNCESINES[store['bouncerate'][indexes],
+                        store['bounce'][indexes]] *
+            store['bounceheight'][indexes]).astype(numpy.int64)
+
+
+def getSquirrelsInArea(store, left, top, right, bottom):
+    # Return the indexes, in order, of the squirrels that overlap the area of
+    # the game world where they are drawn bouncing. Every squirrel moves
+    # every frame, so checking all of them at once costs less than keeping
+    # them sorted into cells of a grid
+    everySquirrel = slice(store['count'])
+    x = store['x'][everySquirrel]
+    y = store['y'][everySquirrel] - getBounceAmounts(store, everySquirrel)
+    return numpy.flatnonzero(
+        (x < right) & (left < x + store['width'][everySquirrel]) &
+        (y < bottom) & (top < y + store['height'][everySquirrel]))
+
+
+def isOutsideActiveArea(camerax, cameray, store):
+    # Return a boolean array telling which squirrels are more than a
+    # half-window length beyond the edge of the window
+    count = store['count']
+    x = store['x'][:count]
+    y = store['y'][:count]
+    return ~((camerax - WINWIDTH < x + store['width'][:count]) &
+             (x < camerax + 2 * WINWIDTH) &
+             (cameray - WINHEIGHT < y + store['height'][:count]) &
+             (y < cameray + 2 * WINHEIGHT))
 
 
 if __name__ == '__main__':